@@ -0,0 +1,118 @@
+"""
+photos3.clients
+===============
+Contains code for creating AWS service clients
+
+Low-level clients are thread safe, so a single client per service is shared
+by every thread, letting concurrent work reuse one connection pool. boto3
+sessions and resources are not safe to share, so each thread gets its own
+session for resources. Everything is created on first use. Clients are then
+cached for the life of the container and sessions & resources for the life
+of their thread, so work should run on long-lived threads, such as those of
+a pool held at module level, for its resources to be reused.
+
+Connection handling is tuned through the environment:
+
+``CLIENT_MAX_POOL_CONNECTIONS``
+    Connections kept open per client (default 50)
+``CLIENT_CONNECT_TIMEOUT`` / ``CLIENT_READ_TIMEOUT``
+    Socket timeouts in seconds (default 5 / 60)
+``CLIENT_RETRY_MODE`` / ``CLIENT_MAX_RETRIES``
+    botocore retry mode & retries per request (default ``adaptive`` / 5)
+``CLIENT_TCP_KEEPALIVE``
+    Whether to enable TCP keep-alive (default ``true``)
+"""
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+
+MAX_POOL_CONNECTIONS = int(os.environ.get('CLIENT_MAX_POOL_CONNECTIONS', 50))
+CONNECT_TIMEOUT = float(os.environ.get('CLIENT_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('CLIENT_READ_TIMEOUT', 60))
+RETRY_MODE = os.environ.get('CLIENT_RETRY_MODE', 'adaptive')
+MAX_RETRIES = int(os.environ.get('CLIENT_MAX_RETRIES', 5))
+TCP_KEEPALIVE = os.environ.get('CLIENT_TCP_KEEPALIVE',
+                               'true').lower() == 'true'
+
+
+_local = threading.local()
+_lock = threading.Lock()
+_shared_session = None
+_shared_clients = {}
+
+
+def client_config():
+    """
+    Returns the botocore configuration every client is created with
+
+    :rtype: botocore.config.Config
+    """
+    options = {
+        'max_pool_connections': MAX_POOL_CONNECTIONS,
+        'connect_timeout': CONNECT_TIMEOUT,
+        'read_timeout': READ_TIMEOUT,
+        'retries': {
+            'mode': RETRY_MODE,
+            'max_attempts': MAX_RETRIES,
+        },
+    }
+
+    # Only newer botocore releases can enable TCP keep-alive
+    if 'tcp_keepalive' in Config.OPTION_DEFAULTS:
+        options['tcp_keepalive'] = TCP_KEEPALIVE
+
+    return Config(**options)
+
+
+def _session():
+    """
+    Returns the calling thread's boto3 session
+
+    :rtype: boto3.session.Session
+    """
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = _local.session = boto3.session.Session()
+        _local.resources = {}
+
+    return session
+
+
+def client(service_name):
+    """
+    Returns the client for an AWS service shared by every thread
+
+    :param service_name: Name of the AWS service, e.g. ``sns``
+    :type service_name: str
+    """
+    global _shared_session
+
+    if service_name not in _shared_clients:
+        with _lock:
+            if service_name not in _shared_clients:
+                if _shared_session is None:
+                    _shared_session = boto3.session.Session()
+                _shared_clients[service_name] = _shared_session.client(
+                    service_name,
+                    config=client_config())
+
+    return _shared_clients[service_name]
+
+
+def resource(service_name):
+    """
+    Returns the calling thread's resource for an AWS service
+
+    :param service_name: Name of the AWS service, e.g. ``s3``
+    :type service_name: str
+    """
+    session = _session()
+    if service_name not in _local.resources:
+        _local.resources[service_name] = session.resource(
+            service_name,
+            config=client_config())
+
+    return _local.resources[service_name]
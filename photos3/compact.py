@@ -0,0 +1,137 @@
+"""
+photos3.compact
+===============
+Contains code for compactly encoding metadata documents
+
+A document is any combination of dicts, lists, tuples, text, numbers,
+booleans, ``None`` and bytes. Its structure is kept as JSON, with every bytes
+value stored raw in a binary section after the JSON rather than base64
+encoded, the JSON holding only its offset & length. The payload is zlib
+compressed whenever that makes it smaller.
+
+Encoded layout::
+
+    format byte | [zlib compressed]( JSON length | JSON | binary section )
+
+Tuples decode as lists and dict keys as text, as they would from JSON.
+"""
+import json
+import os
+import struct
+import zlib
+
+
+COMPRESSION_LEVEL = int(os.environ.get('COMPACT_COMPRESSION_LEVEL', 9))
+
+# Leading byte telling whether the rest of the payload is compressed
+RAW = b'\x00'
+ZLIB = b'\x01'
+
+# Key of the JSON object standing in for a bytes value. Document keys
+# starting with '$' are escaped with another '$' so they never clash.
+_BYTES = '$b'
+
+_LENGTH = struct.Struct('>I')
+
+
+def _pack(value, blobs):
+    """
+    Returns a value with its bytes replaced by references into ``blobs``
+
+    :param value: Document value
+    :param blobs: Raw bytes collected so far, appended to
+    :type blobs: list
+    """
+    if isinstance(value, dict):
+        return {
+            _escape(str(k)): _pack(v, blobs)
+            for k, v in value.items()
+        }
+
+    if isinstance(value, (list, tuple)):
+        return [_pack(v, blobs) for v in value]
+
+    if isinstance(value, (bytes, bytearray)):
+        offset = sum(len(b) for b in blobs)
+        blobs.append(bytes(value))
+        return {_BYTES: [offset, len(value)]}
+
+    return value
+
+
+def _unpack(value, blobs):
+    """
+    Returns a value with its references into ``blobs`` replaced by bytes
+
+    :param value: Decoded JSON value
+    :param blobs: Binary section of the payload
+    :type blobs: bytes
+    """
+    if isinstance(value, dict):
+        if len(value) == 1 and _BYTES in value:
+            offset, length = value[_BYTES]
+            return blobs[offset:offset + length]
+
+        return {
+            _unescape(k): _unpack(v, blobs)
+            for k, v in value.items()
+        }
+
+    if isinstance(value, list):
+        return [_unpack(v, blobs) for v in value]
+
+    return value
+
+
+def _escape(key):
+    return '$' + key if key.startswith('$') else key
+
+
+def _unescape(key):
+    return key[1:] if key.startswith('$') else key
+
+
+def encode(value):
+    """
+    Encodes a document
+
+    :param value: Document
+    :returns: Encoded document
+    :rtype: bytes
+    """
+    blobs = []
+    document = json.dumps(_pack(value, blobs),
+                          separators=(',', ':'),
+                          ensure_ascii=False).encode('utf-8')
+
+    payload = b''.join([_LENGTH.pack(len(document)), document] + blobs)
+
+    compressed = zlib.compress(payload, COMPRESSION_LEVEL)
+    if len(compressed) < len(payload):
+        return ZLIB + compressed
+    return RAW + payload
+
+
+def decode(data):
+    """
+    Decodes a document
+
+    :param data: Encoded document
+    :type data: bytes
+    :returns: Document
+    :raises ValueError: If the data is not an encoded document
+    """
+    data = bytes(data)
+    if data[:1] == ZLIB:
+        payload = zlib.decompress(data[1:])
+    elif data[:1] == RAW:
+        payload = data[1:]
+    else:
+        raise ValueError("Unknown compact document format {!r}".format(
+            data[:1]))
+
+    length, = _LENGTH.unpack_from(payload)
+    start = _LENGTH.size
+    document = json.loads(payload[start:start + length].decode('utf-8'))
+
+    return _unpack(document, payload[start + length:])
@@ -0,0 +1,143 @@
+"""
+photos3.fanout
+==============
+Contains code for requesting thumbnail generation
+"""
+import json
+
+
+# SNS accepts at most 10 entries per PublishBatch call, with every message
+# and the batch as a whole limited to 256 KiB
+PUBLISH_BATCH_ENTRIES = 10
+PUBLISH_MAX_BYTES = 256 * 1024
+
+
+def thumbnail_request(ingested, sizes):
+    """
+    Returns the rendition spec for one ingested image
+
+    :param ingested: Newly ingested image
+    :type ingested: photos3.imgprocess.IngestedImage
+    :param sizes: Maximum width & height of each thumbnail
+    :type sizes: list
+    :rtype: dict
+    """
+    return {
+        's3_bucket': ingested.s3_object.bucket_name,
+        's3_key': ingested.s3_object.key,
+        'checksum': ingested.checksum,
+        'etag': ingested.etag,
+        'width': ingested.width,
+        'height': ingested.height,
+        'sizes': [list(size) for size in sizes],
+    }
+
+
+def pack_thumbnail_requests(requests, images_per_message=1,
+                            sizes_per_message=None):
+    """
+    Packs rendition specs into as few SNS messages as possible
+
+    :param requests: Rendition specs from :func:`thumbnail_request`
+    :type requests: list
+    :param images_per_message: Most images a single thumbnail worker
+        invocation should render
+    :type images_per_message: int
+    :param sizes_per_message: Most sizes rendered per image & invocation. All
+        of an image's sizes are kept together when unset.
+    :type sizes_per_message: int
+    :returns: Message bodies, each of the form ``{'images': [...]}``
+    :rtype: list
+    """
+    images = []
+    for request in requests:
+        sizes = request['sizes']
+        step = sizes_per_message or len(sizes) or 1
+        for i in range(0, len(sizes), step):
+            image = dict(request)
+            image['sizes'] = sizes[i:i + step]
+            images.append(image)
+
+    messages = []
+    current = []
+    for image in images:
+        candidate = current + [image]
+        if current and (len(candidate) > images_per_message or
+                        _message_size({'images': candidate}) >
+                        PUBLISH_MAX_BYTES):
+            messages.append({'images': current})
+            candidate = [image]
+        current = candidate
+
+    if current:
+        messages.append({'images': current})
+
+    return messages
+
+
+def _encode_message(message):
+    """
+    Encodes a message body for a JSON structured SNS message
+
+    :param message: Message body
+    :type message: dict
+    :rtype: str
+    """
+    return json.dumps({'default': json.dumps(message)})
+
+
+def _message_size(message):
+    """
+    Returns the encoded size of a message body in bytes
+
+    :param message: Message body
+    :type message: dict
+    :rtype: int
+    """
+    return len(_encode_message(message).encode('utf-8'))
+
+
+def publish_thumbnail_requests(sns, topic_arn, messages):
+    """
+    Publishes thumbnail requests using as few SNS calls as possible
+
+    :param sns: SNS client
+    :param topic_arn: ARN of the thumbnail worker topic
+    :type topic_arn: str
+    :param messages: Message bodies from :func:`pack_thumbnail_requests`
+    :type messages: list
+    :raises RuntimeError: If SNS rejected any of the messages
+    """
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for message in messages:
+        encoded = _encode_message(message)
+        encoded_bytes = len(encoded.encode('utf-8'))
+        if batch and (len(batch) >= PUBLISH_BATCH_ENTRIES or
+                      batch_bytes + encoded_bytes > PUBLISH_MAX_BYTES):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(encoded)
+        batch_bytes += encoded_bytes
+
+    if batch:
+        batches.append(batch)
+
+    for batch in batches:
+        response = sns.publish_batch(
+            TopicArn=topic_arn,
+            PublishBatchRequestEntries=[
+                {
+                    'Id': str(i),
+                    'Message': encoded,
+                    'MessageStructure': 'json',
+                }
+                for i, encoded in enumerate(batch)
+            ])
+
+        if response.get('Failed'):
+            raise RuntimeError(
+                "Failed to publish thumbnail requests: {}".format(
+                    response['Failed']))
@@ -0,0 +1,238 @@
+"""
+photos3.geohash
+===============
+Contains code for geohashing positions & planning spatial queries
+
+A geohash interleaves the bits of a position's longitude & latitude and
+writes them five at a time in base 32, so positions sharing a prefix lie in
+the same cell. Each character narrows a cell to 1/32 of its parent.
+"""
+import math
+
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# Mean radius of the Earth in metres
+EARTH_RADIUS = 6371008.8
+
+# Metres per degree of latitude
+METRES_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def encode(latitude, longitude, precision=12):
+    """
+    Returns the geohash of a position
+
+    :param latitude: Latitude in decimal degrees
+    :type latitude: float
+    :param longitude: Longitude in decimal degrees
+    :type longitude: float
+    :param precision: Number of characters
+    :type precision: int
+    :rtype: str
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+
+    chars = []
+    bits = 0
+    for n in range(precision * 5):
+        # Even bits halve the longitude & odd ones the latitude
+        value, span = ((longitude, lon_range) if n % 2 == 0
+                       else (latitude, lat_range))
+        mid = (span[0] + span[1]) / 2
+        if value >= mid:
+            bits = bits * 2 + 1
+            span[0] = mid
+        else:
+            bits *= 2
+            span[1] = mid
+
+        if n % 5 == 4:
+            chars.append(BASE32[bits])
+            bits = 0
+
+    return ''.join(chars)
+
+
+def bounds(geohash):
+    """
+    Returns the cell a geohash stands for
+
+    :param geohash: Geohash
+    :type geohash: str
+    :returns: South, west, north & east edges in decimal degrees
+    :rtype: tuple
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+
+    n = 0
+    for char in geohash:
+        bits = BASE32.index(char)
+        for shift in range(4, -1, -1):
+            span = lon_range if n % 2 == 0 else lat_range
+            mid = (span[0] + span[1]) / 2
+            if bits >> shift & 1:
+                span[0] = mid
+            else:
+                span[1] = mid
+            n += 1
+
+    return lat_range[0], lon_range[0], lat_range[1], lon_range[1]
+
+
+def _cell_size(precision):
+    """
+    Returns the height & width of cells in degrees at a precision
+    """
+    lon_bits = (precision * 5 + 1) // 2
+    lat_bits = precision * 5 // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def _cell_span(low, high, origin, step, count):
+    """
+    Returns the range of cell indices covering a span of degrees
+    """
+    first = int(math.floor((low - origin) / step))
+    last = int(math.floor((high - origin) / step))
+    return range(max(first, 0), min(last, count - 1) + 1)
+
+
+def cells(south, west, north, east, precision):
+    """
+    Returns the geohashes of every cell overlapping a bounding box
+
+    :param south: Southern edge in decimal degrees
+    :param west: Western edge in decimal degrees; greater than ``east``
+        when the box crosses the antimeridian
+    :param north: Northern edge in decimal degrees
+    :param east: Eastern edge in decimal degrees
+    :param precision: Length of the geohashes
+    :type precision: int
+    :rtype: list
+    """
+    if west > east:
+        return (cells(south, west, north, 180.0, precision) +
+                cells(south, -180.0, north, east, precision))
+
+    height, width = _cell_size(precision)
+    rows = _cell_span(south, north, -90.0, height, int(180 / height))
+    columns = _cell_span(west, east, -180.0, width, int(360 / width))
+
+    return [
+        encode(-90.0 + (row + 0.5) * height,
+               -180.0 + (column + 0.5) * width,
+               precision)
+        for row in rows
+        for column in columns
+    ]
+
+
+def cell_count(south, west, north, east, precision):
+    """
+    Returns the number of cells :func:`cells` would return, without
+    listing them
+
+    :rtype: int
+    """
+    if west > east:
+        return (cell_count(south, west, north, 180.0, precision) +
+                cell_count(south, -180.0, north, east, precision))
+
+    height, width = _cell_size(precision)
+    return (len(_cell_span(south, north, -90.0, height, int(180 / height))) *
+            len(_cell_span(west, east, -180.0, width, int(360 / width))))
+
+
+def covering_cells(south, west, north, east, min_precision=1,
+                   max_precision=12, max_cells=16):
+    """
+    Returns the smallest cells covering a bounding box with at most
+    ``max_cells`` of them
+
+    Finer cells cover less outside of the box, so fewer candidates are read
+    and discarded, but take more queries. The cells are never coarser than
+    ``min_precision``, even if that takes more than ``max_cells``: a large
+    box can need thousands of them, so callers holding to a precision
+    should check :func:`cell_count` at it first.
+
+    :param south: Southern edge in decimal degrees
+    :param west: Western edge in decimal degrees
+    :param north: Northern edge in decimal degrees
+    :param east: Eastern edge in decimal degrees
+    :param min_precision: Shortest geohashes to return
+    :type min_precision: int
+    :param max_precision: Longest geohashes to return
+    :type max_precision: int
+    :param max_cells: Most cells to return when not held to
+        ``min_precision``
+    :type max_cells: int
+    :rtype: list
+    """
+    precision = min_precision
+    while (precision < max_precision and
+           cell_count(south, west, north, east,
+                       precision + 1) <= max_cells):
+        precision += 1
+
+    return cells(south, west, north, east, precision)
+
+
+def radius_bounds(latitude, longitude, radius):
+    """
+    Returns a bounding box enclosing a circle
+
+    :param latitude: Latitude of the centre in decimal degrees
+    :param longitude: Longitude of the centre in decimal degrees
+    :param radius: Radius in metres
+    :returns: South, west, north & east edges in decimal degrees
+    :rtype: tuple
+    """
+    delta_lat = radius / METRES_PER_DEGREE
+    south = max(latitude - delta_lat, -90.0)
+    north = min(latitude + delta_lat, 90.0)
+
+    # Circles reaching a pole span every longitude. Otherwise they are
+    # widest where the box is furthest from the equator.
+    if south == -90.0 or north == 90.0:
+        return south, -180.0, north, 180.0
+
+    delta_lon = delta_lat / math.cos(math.radians(max(abs(south),
+                                                      abs(north))))
+    if delta_lon >= 180.0:
+        return south, -180.0, north, 180.0
+
+    west = (longitude - delta_lon + 540.0) % 360.0 - 180.0
+    east = (longitude + delta_lon + 540.0) % 360.0 - 180.0
+    return south, west, north, east
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Returns the great circle distance between two positions in metres
+
+    :rtype: float
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+
+    a = (math.sin(d_phi / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(math.sqrt(a), 1.0))
+
+
+def in_bounds(latitude, longitude, south, west, north, east):
+    """
+    Returns whether a position lies within a bounding box
+
+    :rtype: bool
+    """
+    if not south <= latitude <= north:
+        return False
+    if west > east:
+        return longitude >= west or longitude <= east
+    return west <= longitude <= east
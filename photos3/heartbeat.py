@@ -0,0 +1,99 @@
+"""
+photos3.heartbeat
+=================
+Contains code for keeping in-flight SQS messages invisible
+"""
+import threading
+
+from photos3 import clients
+
+
+class VisibilityHeartbeat(threading.Thread):
+    """
+    Periodically extends the visibility timeout of in-flight messages
+
+    Lets the queue's own visibility timeout stay short, so failures are
+    retried quickly, while messages that are merely slow to process are not
+    handed to another consumer. The heartbeat runs on its own thread using
+    the shared, thread safe SQS client.
+    """
+    def __init__(self, queue_url, timeout=60, interval=None):
+        """
+        :param queue_url: URL of the SQS queue
+        :type queue_url: str
+        :param timeout: Seconds each extension keeps messages invisible for
+        :type timeout: int
+        :param interval: Seconds between extensions, a third of ``timeout``
+            by default
+        :type interval: float
+        """
+        super(VisibilityHeartbeat, self).__init__()
+        self.daemon = True
+
+        self.queue_url = queue_url
+        self.timeout = timeout
+        self.interval = interval or timeout / 3.0
+
+        self._messages = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def add(self, messages):
+        """
+        Starts extending the visibility of messages
+
+        :param messages: Messages received from the queue
+        :type messages: list
+        """
+        with self._lock:
+            for msg_obj in messages:
+                self._messages[msg_obj.receipt_handle] = msg_obj
+
+    def discard(self, messages):
+        """
+        Stops extending the visibility of messages
+
+        :param messages: Messages no longer being processed
+        :type messages: list
+        """
+        with self._lock:
+            for msg_obj in messages:
+                self._messages.pop(msg_obj.receipt_handle, None)
+
+    def beat(self):
+        """
+        Extends the visibility of every in-flight message, 10 per request
+        """
+        with self._lock:
+            receipt_handles = list(self._messages)
+
+        for i in range(0, len(receipt_handles), 10):
+            response = clients.client('sqs').change_message_visibility_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {
+                        'Id': str(n),
+                        'ReceiptHandle': receipt_handle,
+                        'VisibilityTimeout': self.timeout,
+                    }
+                    for n, receipt_handle
+                    in enumerate(receipt_handles[i:i + 10])
+                ])
+
+            for failure in response.get('Failed', []):
+                print("Failed to extend message visibility: {}".format(
+                    failure))
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.beat()
+            except Exception as e:
+                # Keep beating; the next attempt may well succeed
+                print("Visibility heartbeat failed: {}".format(e))
+
+    def stop(self):
+        """
+        Stops the heartbeat
+        """
+        self._stopped.set()
@@ -3,18 +3,83 @@ photos3.imgprocess
 ==================
 Contains code for processing images
 """
-import base64
+import collections
+import concurrent.futures
+import datetime
+import functools
+import io
+import mimetypes
+import numbers
 import os
 import pathlib
+import struct
 import tempfile
+import time
 
-from PIL import Image
 from PIL.ExifTags import GPSTAGS
 from PIL.ExifTags import TAGS
 from hashlib import sha256
 
-from photos3.model import AlbumImage
-from photos3.model import ImageMetaData
+from photos3 import clients
+from photos3 import metadata
+from photos3.metrics import emit
+
+
+# Objects larger than this many bytes are spooled to disk while being
+# processed rather than held entirely in memory
+SPOOL_MAX_SIZE = int(os.environ.get('IMAGE_SPOOL_MAX_SIZE',
+                                    32 * 1024 * 1024))
+
+# Size of each read from an S3 object's body
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Number of ingest stages (copies & database writes) run concurrently,
+# shared by every image being ingested
+INGEST_STAGE_WORKERS = int(os.environ.get('INGEST_STAGE_WORKERS', 8))
+
+# Originals at least this many bytes are copied with a managed multipart copy
+# of COPY_PART_SIZE parts, COPY_CONCURRENCY at a time, rather than a single
+# CopyObject call (which fails outright above 5 GB)
+COPY_MULTIPART_THRESHOLD = int(os.environ.get('COPY_MULTIPART_THRESHOLD',
+                                              64 * 1024 * 1024))
+COPY_PART_SIZE = int(os.environ.get('COPY_PART_SIZE', 64 * 1024 * 1024))
+COPY_CONCURRENCY = int(os.environ.get('COPY_CONCURRENCY', 10))
+
+# Upper bounds (exclusive) of the size classes copy throughput is reported by
+COPY_SIZE_CLASSES = [
+    (1024 * 1024, '<1MB'),
+    (16 * 1024 * 1024, '1-16MB'),
+    (256 * 1024 * 1024, '16-256MB'),
+    (5 * 1024 * 1024 * 1024, '256MB-5GB'),
+]
+
+# Leading bytes fetched when only an image's header is needed, and the most
+# that range is widened to when the header runs past it
+METADATA_RANGE_BYTES = int(os.environ.get('METADATA_RANGE_BYTES',
+                                          64 * 1024))
+METADATA_RANGE_MAX_BYTES = int(os.environ.get('METADATA_RANGE_MAX_BYTES',
+                                              4 * 1024 * 1024))
+
+
+# EXIF tags saying when an image was captured, most trusted first
+CAPTURE_TIME_TAGS = ['DateTimeOriginal', 'DateTimeDigitized', 'DateTime']
+
+
+_stage_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=INGEST_STAGE_WORKERS)
+
+
+# Result of ingesting a new image, carrying everything the thumbnail workers
+# need so they can skip their own lookups
+IngestedImage = collections.namedtuple('IngestedImage', [
+    's3_object',
+    'metadata',
+    'checksum',
+    'etag',
+    'width',
+    'height',
+    'duplicate',
+])
 
 
 def get_image_data(img):
@@ -28,152 +93,882 @@ def get_image_data(img):
     basicdata = {}
 
     if img.info:
-        basicdata = {
+        basicdata = _typed({
             k: v
             for k, v in img.info.items()
             if k != 'exif'
-        }
-
-    for k, v in basicdata.items():
-        if type(v) is bytes:
-            basicdata.update({
-                k: str(base64.b64encode(v)),
-            })
+        })
 
     exifdata = {}
     try:
         # Read exif data from image, if available
-        raw_exif = img._getexif()
+        raw_exif = _raw_exif(img)
 
         # Convert tag codes into named values
-        exifdata = {
-            TAGS.get(tag, tag): str(val).strip()
+        exifdata = _typed({
+            TAGS.get(tag, tag): val.strip() if isinstance(val, str) else val
             for tag, val in raw_exif.items()
-        }
+        })
 
     except AttributeError:
         pass
 
-    for k, v in exifdata.items():
-        if type(v) is bytes:
-            exifdata.update({
-                k: str(base64.b64encode(v)),
-            })
+    # Name the GPS values too
+    if isinstance(exifdata.get('GPSInfo'), dict):
+        exifdata['GPSInfo'] = _gps_info({
+            GPSTAGS.get(int(tag), tag): val
+            for tag, val in exifdata['GPSInfo'].items()
+        })
 
     return basicdata, exifdata
 
 
-def _get_image_from_s3(s3_object):
+def _raw_exif(img):
+    """
+    Returns an image's EXIF tags by code, GPS tags nested under
+    ``GPSInfo``, as JPEGs' ``_getexif()`` does
+
+    :param img: PIL image
+    :rtype: dict
+    :raises AttributeError: If the image has no EXIF data
+    """
+    if hasattr(img, '_getexif'):
+        return img._getexif()
+
+    # Other formats, such as TIFF, keep the EXIF & GPS IFDs apart
+    exif = img.getexif()
+    raw_exif = dict(exif)
+    raw_exif.update(exif.get_ifd(metadata.EXIF_IFD))
+    if metadata.GPS_IFD in raw_exif:
+        raw_exif[metadata.GPS_IFD] = dict(exif.get_ifd(metadata.GPS_IFD))
+    return raw_exif
+
+
+def _typed(value):
+    """
+    Converts a metadata value into one that can be stored by
+    :class:`photos3.model.CompactAttribute`
+
+    :param value: Value from :mod:`photos3.metadata` or PIL
+    :returns: Value with text keys, rationals as floats & tuples as lists,
+        bytes being left as they are
+    """
+    if isinstance(value, dict):
+        return {str(k): _typed(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_typed(v) for v in value]
+    if isinstance(value, numbers.Number) and \
+            not isinstance(value, (int, float)):
+        # e.g. PIL's IFDRational
+        return float(value)
+    return value
+
+
+def _gps_info(gpsdata):
+    """
+    Returns named GPS values along with the position they describe, as
+    ``Latitude`` & ``Longitude`` in decimal degrees and ``Altitude`` in
+    metres
+
+    :param gpsdata: GPS values by name
+    :type gpsdata: dict
+    :rtype: dict
+    """
+    gpsdata = dict(gpsdata)
+    for key, value in metadata.gps_position(gpsdata).items():
+        gpsdata[key.capitalize()] = value
+    return gpsdata
+
+
+def get_header_data(data):
+    """
+    Returns basic information, exif data and dimensions from the leading
+    bytes of an image, without decoding it
+
+    GPS values are nested under ``GPSInfo`` along with the position in
+    decimal degrees.
+
+    :param data: Leading bytes of the image
+    :type data: bytes
+    :returns: Tuple of basic info, exif info and (width, height)
+    :rtype: tuple
+    :raises photos3.metadata.HeaderTruncated: If more bytes are needed
+    :raises photos3.metadata.UnknownFormat: If the format is not supported
+    """
+    header = metadata.parse(data)
+
+    exifdata = dict(header['exif'])
+    if header['gps']:
+        exifdata['GPSInfo'] = _gps_info(header['gps'])
+
+    return (_typed(header['info']),
+            _typed(exifdata),
+            (header['width'], header['height']))
+
+
+def captured_time(exifdata):
+    """
+    Returns when an image was captured according to its EXIF data
+
+    The ``CAPTURE_TIME_TAGS`` are tried in turn, then the date & time of the
+    GPS fix.
+
+    :param exifdata: EXIF data, as returned by :func:`get_header_data`
+    :type exifdata: dict
+    :returns: Capture time as ``YYYY-MM-DDTHH:MM:SS``, or None if unknown
+    :rtype: str
+    """
+    for tag in CAPTURE_TIME_TAGS:
+        value = exifdata.get(tag)
+        if not isinstance(value, str):
+            continue
+
+        try:
+            return datetime.datetime.strptime(
+                value.strip(' \x00'),
+                '%Y:%m:%d %H:%M:%S').isoformat()
+        except ValueError:
+            continue
+
+    # Failing those, the (UTC) time of the GPS fix
+    gpsdata = exifdata.get('GPSInfo')
+    if isinstance(gpsdata, dict):
+        try:
+            date = datetime.datetime.strptime(
+                gpsdata['GPSDateStamp'].strip(' \x00'), '%Y:%m:%d')
+            hours, minutes, seconds = gpsdata.get('GPSTimeStamp', (0, 0, 0))
+            return (date + datetime.timedelta(
+                hours=hours,
+                minutes=minutes,
+                seconds=int(seconds))).isoformat()
+        except (AttributeError, KeyError, TypeError, ValueError):
+            pass
+
+    return None
+
+
+def _read_header(read_leading, max_length=None):
     """
-    Downloads & returns a temporary file and PIL image
+    Parses an image header, reading more leading bytes only when needed
+
+    Formats not supported by :mod:`photos3.metadata` fall back to PIL.
+
+    :param read_leading: Callable given a byte count, returning up to that
+        many leading bytes and whether they are the whole image
+    :param max_length: Most leading bytes to read, if limited
+    :type max_length: int
+    :returns: Tuple of basic info, exif info and (width, height)
+    :rtype: tuple
+    """
+    length = METADATA_RANGE_BYTES
+    while True:
+        data, complete = read_leading(length)
+
+        try:
+            try:
+                return get_header_data(data)
+            except metadata.UnknownFormat:
+                from PIL import Image
+                img = Image.open(io.BytesIO(data))
+                basicdata, exifdata = get_image_data(img)
+                return basicdata, exifdata, img.size
+
+        except metadata.HeaderTruncated as e:
+            # Give up once the whole object (or as much as we're willing to
+            # read) has been tried
+            if complete or (max_length and length >= max_length):
+                raise
+            length = max(e.needed, length * 2)
+
+        except (EOFError, IOError, SyntaxError, ValueError, struct.error):
+            if complete or (max_length and length >= max_length):
+                raise
+            length = length * 4
+
+        if max_length:
+            length = min(length, max_length)
+
+
+def _download_from_s3(s3_object, etag=None, hasher=None):
+    """
+    Streams an S3 object into a spooled buffer
+
+    The buffer is kept in memory until it grows past ``SPOOL_MAX_SIZE``, at
+    which point it spills over to an anonymous temporary file. When given a
+    hasher, every chunk is fed to it as it arrives so the object never needs
+    a second pass to be checksummed.
+
+    :param s3_object: Photo in S3
+    :type s3_object: boto3.resources.factory.s3.Object
+    :param etag: Expected ETag of the object. When known, the object is
+        fetched with a conditional GET.
+    :type etag: str
+    :param hasher: hashlib object to update with the object's content
+    :returns: Buffer positioned at the start of the object
+    :rtype: tempfile.SpooledTemporaryFile
+    """
+    get_args = {}
+    if etag:
+        get_args['IfMatch'] = etag
+
+    body = s3_object.get(**get_args)['Body']
+    buf = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+    for chunk in iter(lambda: body.read(DOWNLOAD_CHUNK_SIZE), b''):
+        if hasher is not None:
+            hasher.update(chunk)
+        buf.write(chunk)
+
+    buf.seek(0)
+    return buf
+
+
+def _hash_from_s3(s3_object, hasher):
+    """
+    Streams an S3 object through a hasher without keeping its content
+
+    :param s3_object: Photo in S3
+    :type s3_object: boto3.resources.factory.s3.Object
+    :param hasher: hashlib object to update with the object's content
+    :returns: ETag of the object that was read
+    :rtype: str
+    """
+    response = s3_object.get()
+    body = response['Body']
+
+    for chunk in iter(lambda: body.read(DOWNLOAD_CHUNK_SIZE), b''):
+        hasher.update(chunk)
+
+    return response['ETag']
+
+
+def read_image_header(s3_object, etag=None):
+    """
+    Reads an image's metadata & dimensions from a leading byte range
+
+    Starts with ``METADATA_RANGE_BYTES`` and widens the range only when the
+    header runs past it, so the body of the image is usually never
+    downloaded. Headers reaching past ``METADATA_RANGE_MAX_BYTES``, such as
+    TIFFs with their IFDs at the end, are read from the whole image instead.
+
+    :param s3_object: Photo in S3
+    :type s3_object: boto3.resources.factory.s3.Object
+    :param etag: Expected ETag of the object, if known
+    :type etag: str
+    :returns: Tuple of basic info, exif info and (width, height)
+    :rtype: tuple
+    """
+    get_args = {}
+    if etag:
+        get_args['IfMatch'] = etag
+
+    def read_leading(length):
+        response = s3_object.get(
+            Range='bytes=0-{}'.format(length - 1),
+            **get_args)
+        data = response['Body'].read()
+        total_length = int(response['ContentRange'].rpartition('/')[2])
+        return data, len(data) >= total_length
+
+    try:
+        return _read_header(read_leading,
+                            max_length=METADATA_RANGE_MAX_BYTES)
+    except metadata.HeaderTruncated:
+        print("Header needs more than {n} bytes, downloading {k}".format(
+            n=METADATA_RANGE_MAX_BYTES,
+            k=s3_object.key))
+
+    with _download_from_s3(s3_object, etag=etag) as buf:
+        return _read_buffer_header(buf)
+
+
+def _read_buffer_header(buf):
+    """
+    Reads an image's metadata & dimensions from a downloaded buffer
+
+    At most ``METADATA_RANGE_MAX_BYTES`` leading bytes are read into memory.
+    Headers reaching further, such as TIFFs with their IFDs after the pixel
+    data, are left to PIL, which seeks straight to them in the buffer.
+
+    :param buf: Buffer holding the whole image
+    :returns: Tuple of basic info, exif info and (width, height)
+    :rtype: tuple
+    """
+    def read_leading(length):
+        buf.seek(0)
+        data = buf.read(length)
+        return data, len(data) < length or not buf.read(1)
+
+    try:
+        return _read_header(read_leading,
+                            max_length=METADATA_RANGE_MAX_BYTES)
+    except (metadata.HeaderTruncated, EOFError, IOError, SyntaxError,
+            ValueError, struct.error):
+        from PIL import Image
+
+        buf.seek(0)
+        img = Image.open(buf)
+        basicdata, exifdata = get_image_data(img)
+        return basicdata, exifdata, img.size
+
+
+def _get_image_from_s3(s3_object, etag=None, hasher=None):
+    """
+    Downloads & returns a buffer and PIL image
+
+    The buffer must stay open for as long as the image is being used.
 
     :param s3_object: New photo in S3
     :type s3_object: boto3.resources.factory.s3.Object
-    :returns: Tuple of tmp_filename and PIL Image
+    :param etag: Expected ETag of the object, if known
+    :type etag: str
+    :param hasher: hashlib object to update while downloading
+    :returns: Tuple of buffer and PIL Image
     """
-    # Download S3 object to temporary file
-    _, file_extension = os.path.splitext(s3_object.key)
-    tmp_file, tmp_filename = tempfile.mkstemp(suffix=file_extension)
-    s3_object.download_file(tmp_filename)
+    from PIL import Image
+
+    buf = _download_from_s3(s3_object, etag=etag, hasher=hasher)
 
     # Open the image
-    img = Image.open(tmp_filename)
+    img = Image.open(buf)
+
+    return buf, img
+
+
+def _run_stages(*stages):
+    """
+    Runs independent ingest stages concurrently
+
+    Every stage is left to finish, even when another one fails.
+
+    :param stages: Callables taking no arguments
+    :returns: Result of each stage, in order
+    :rtype: list
+    :raises Exception: The first failure among the stages
+    """
+    futures = [_stage_pool.submit(stage) for stage in stages]
+    concurrent.futures.wait(futures)
+    return [future.result() for future in futures]
 
-    return tmp_filename, img
 
+def _copy_size_class(size):
+    """
+    Returns the size class a copied object is reported under
+
+    :param size: Object size in bytes
+    :type size: int
+    :rtype: str
+    """
+    for upper_bound, size_class in COPY_SIZE_CLASSES:
+        if size < upper_bound:
+            return size_class
+    return '>5GB'
+
+
+def copy_object(source, destination, size):
+    """
+    Copies an S3 object server-side, reporting the copy's throughput
+
+    Objects of at least ``COPY_MULTIPART_THRESHOLD`` bytes are copied in
+    parts, several at a time; smaller ones with a single CopyObject call.
+
+    :param source: Object to copy
+    :type source: boto3.resources.factory.s3.Object
+    :param destination: Object to copy to
+    :type destination: boto3.resources.factory.s3.Object
+    :param size: Size of the source object in bytes
+    :type size: int
+    :returns: ETag of the copy
+    :rtype: str
+    """
+    start = time.time()
+
+    if size < COPY_MULTIPART_THRESHOLD:
+        copy_result = destination.copy_from(CopySource="{b}/{k}".format(
+            b=source.bucket_name,
+            k=source.key))
+        etag = copy_result['CopyObjectResult']['ETag']
+
+    else:
+        from boto3.s3.transfer import TransferConfig
+
+        destination.copy(
+            {'Bucket': source.bucket_name, 'Key': source.key},
+            Config=TransferConfig(
+                multipart_threshold=COPY_MULTIPART_THRESHOLD,
+                multipart_chunksize=COPY_PART_SIZE,
+                max_concurrency=COPY_CONCURRENCY))
+        destination.load()
+        etag = destination.e_tag
+
+    elapsed = max(time.time() - start, 0.001)
+    emit({
+        'CopyBytes': size,
+        'CopySeconds': elapsed,
+        'CopyThroughput': size / elapsed,
+    }, dimensions={
+        'SizeClass': _copy_size_class(size),
+    }, units={
+        'CopyBytes': 'Bytes',
+        'CopySeconds': 'Seconds',
+        'CopyThroughput': 'Bytes/Second',
+    })
+
+    return etag
+
+
+def _delete_object(bucket, key):
+    """
+    Deletes an S3 object using the calling thread's own resources
+
+    :param bucket: Bucket name
+    :type bucket: str
+    :param key: S3 key
+    :type key: str
+    """
+    clients.resource('s3').Object(bucket, key).delete()
+
+
+def _album_name(key, upload_prefix):
+    """
+    Decodes an uploaded file's path to see if it should be classified into
+    an album
+
+    :param key: S3 key of the uploaded file
+    :type key: str
+    :param upload_prefix: S3 key prefix for uploaded images
+    :type upload_prefix: str
+    :returns: Album name, if any
+    :rtype: str
+    """
+    upload_path = pathlib.Path(key[len(upload_prefix):])
+    if len(upload_path.parts) > 2:
+        return "/".join(upload_path.parts[1:-1])
 
-def ingest_image(s3_object, original_prefix, upload_prefix):
+
+def ingest_image(s3_object, original_prefix, upload_prefix,
+                 metadata_first=False, writer=None):
     """
     Handles new image ingestion
 
+    An image whose checksum was already ingested, or is being ingested from
+    another upload sharing the ``writer``, is not copied, re-recorded or
+    re-thumbnailed; it is only linked to its album and the upload removed.
+
     :param s3_object: New photo in S3
     :type s3_object: boto3.resources.factory.s3.Object
     :param original_prefix: S3 key prefix for original images
     :type original_prefix: str
     :param upload_prefix: S3 key prefix for uploaded images
     :type upload_prefix: str
-    :returns: DynamoDB entry for new metadata
-    :rtype: photos3.model.ImageMetaData
+    :param metadata_first: Read metadata from a leading byte range while
+        only streaming the full body through the checksum, never buffering
+        or decoding it
+    :type metadata_first: bool
+    :param writer: Batch to queue the database writes in rather than making
+        them immediately, other than the conditional write adding the image
+        to its album. The upload is then only removed once the batch has
+        been flushed.
+    :type writer: photos3.model.WriteBatch
+    :returns: Original image in S3 & its DynamoDB metadata entry, which is
+        None for a duplicate of another upload in the same batch
+    :rtype: IngestedImage
     """
-    tmp_filename, img = _get_image_from_s3(s3_object)
-
-    # Read all metadata from the file
-    basicdata, exifdata = get_image_data(img)
-
-    # Determine checksum of the file
-    with open(tmp_filename, 'rb') as imgin:
-        checksum = sha256(imgin.read()).hexdigest()
-
-    # Remove the image
-    try:
-        os.remove(tmp_filename)
-    except Exception:
-        # Ignore the inability to remove the file
-        pass
+    from photos3.model import AlbumSummary
+    from photos3.model import ImageLocation
+    from photos3.model import ImageMetaData
+    from photos3.model import ImageSummary
+    from photos3.model import ImageTimeline
+    from photos3.model import image_cache
+
+    # Entries for the writer's batch, only handed over once every stage
+    # has succeeded so a failed image leaves nothing behind to be flushed
+    queued = []
+
+    def save(entry, cache, stages):
+        # Write an entry now (as an ingest stage) or with the writer's
+        # batch, caching it once written
+        def write():
+            entry.save()
+            if cache is not None:
+                cache.put(entry)
+
+        if writer is None:
+            stages.append(write)
+        else:
+            queued.append((entry, cache))
+
+    # Determine checksum of the file as it downloads
+    hasher = sha256()
+    if metadata_first:
+        # The header is read alongside, on a stage thread with its own
+        # resources, and only used if the image turns out to be new
+        buf = None
+        header_etag = s3_object.e_tag
+        header = _stage_pool.submit(
+            lambda: read_image_header(
+                clients.resource('s3').Object(s3_object.bucket_name,
+                                              s3_object.key),
+                etag=header_etag))
+        upload_etag = _hash_from_s3(s3_object, hasher)
+    else:
+        buf = _download_from_s3(s3_object, hasher=hasher)
+    checksum = hasher.hexdigest()
 
-    # Create a new object in the originals directory
     _, new_key_ext = os.path.splitext(s3_object.key)
     new_key = s3_object.Bucket().Object(
         "{p}/{c}.{e}".format(
             p=original_prefix,
             c=checksum,
             e=new_key_ext))
-    new_key.copy_from(CopySource="{b}/{k}".format(
-        b=s3_object.bucket_name,
-        k=s3_object.key))
-
-    # Save entry to the database
-    image_entry = ImageMetaData(checksum)
-    image_entry.info = basicdata
-    image_entry.exif = exifdata
-    image_entry.save()
-
-    # Delete the originally uploaded file
-    s3_object.delete()
-
-    # Decode the uploaded files path and see if it should be classified into
-    # an album
-    upload_path = pathlib.Path(s3_object.key[len(upload_prefix):])
-    if len(upload_path.parts) > 2:
-        album_name = "/".join(upload_path.parts[1:-1])
+
+    # Look for a previous upload of the same image
+    try:
+        image_entry = image_cache.get(checksum)
+    except ImageMetaData.DoesNotExist:
+        image_entry = None
+
+    size = (None, None)
+    if image_entry is None:
+        # Read all metadata from the file
+        if buf is None and header_etag == upload_etag:
+            basicdata, exifdata, size = header.result()
+        elif buf is None:
+            # Replaced while it was read, so the header is of another image
+            basicdata, exifdata, size = read_image_header(s3_object,
+                                                          etag=upload_etag)
+        else:
+            with buf:
+                basicdata, exifdata, size = _read_buffer_header(buf)
+
+    elif buf is not None:
+        buf.close()
+    else:
+        header.cancel()
+
+    # Another upload of the same image in this batch may be ingesting it
+    # already, without having recorded it yet
+    in_batch = (image_entry is None and writer is not None and
+                not writer.claim(checksum))
+
+    # Once the checksum is known, the copy & database writes run
+    # concurrently. The image's own entry waits for all of them, as a
+    # recorded checksum is taken to mean the image was fully ingested.
+    stages = []
+
+    if image_entry is None and not in_batch:
+        def copy_original():
+            # Create a new object in the originals directory, with resources
+            # of the stage's own thread
+            s3 = clients.resource('s3')
+            return copy_object(
+                s3.Object(s3_object.bucket_name, s3_object.key),
+                s3.Object(new_key.bucket_name, new_key.key),
+                s3_object.content_length)
+
+        # Save entry to the database
+        image_entry = ImageMetaData(checksum)
+        image_entry.info = basicdata
+        image_entry.exif = exifdata
+
+        # Forget that there was no entry
+        image_cache.invalidate(checksum)
+
+        # Along with what listings need to know about the image
+        captured = captured_time(exifdata)
+        orientation = exifdata.get('Orientation')
+        summary_entry = ImageSummary(
+            checksum,
+            key=new_key.key,
+            width=size[0],
+            height=size[1],
+            orientation=(orientation if isinstance(orientation, int)
+                         else None),
+            captured=captured,
+            size=s3_object.content_length,
+            mime_type=(mimetypes.guess_type(s3_object.key)[0] or
+                       s3_object.content_type))
+
+        stages.append(copy_original)
+        save(summary_entry, None, stages)
+
+        # and its place in the timeline, undated images going by when they
+        # were uploaded
+        save(ImageTimeline.entry(
+            captured or
+            s3_object.last_modified.strftime('%Y-%m-%dT%H:%M:%S'),
+            checksum), None, stages)
+
+        # and, if geotagged, its place on the map
+        gpsdata = exifdata.get('GPSInfo')
+        if not isinstance(gpsdata, dict):
+            gpsdata = {}
+        latitude = gpsdata.get('Latitude')
+        longitude = gpsdata.get('Longitude')
+        if isinstance(latitude, float) and isinstance(longitude, float) and \
+                -90 <= latitude <= 90 and -180 <= longitude <= 180:
+            save(ImageLocation.entry(latitude, longitude, checksum),
+                 None, stages)
+        duplicate = False
+
+    elif in_batch:
+        print("Already ingesting {}".format(checksum))
+        captured = captured_time(exifdata)
+        duplicate = True
+
+    else:
+        print("Already ingested {}".format(checksum))
+        captured = captured_time(image_entry.exif or {})
+        duplicate = True
+
+    album_name = _album_name(s3_object.key, upload_prefix)
+    if album_name:
         print("Adding to album '{}'".format(album_name))
 
-        album_entry = AlbumImage(album_name, checksum)
-        album_entry.save()
+        # Conditional writes can't be batched, so the image is added right
+        # away, counting towards the album's totals if new to it
+        stages.append(functools.partial(
+            AlbumSummary.add_image,
+            album_name,
+            checksum,
+            size=s3_object.content_length,
+            captured=captured))
+
+    results = _run_stages(*stages)
+    etag = None if duplicate else results[0]
+
+    if not duplicate:
+        if writer is None:
+            image_entry.save()
+            image_cache.put(image_entry)
+        else:
+            queued.append((image_entry, image_cache))
+
+    # Delete the originally uploaded file, once everything depending on it
+    # has succeeded
+    if writer is None:
+        s3_object.delete()
+    else:
+        # The image's own entry goes last, so it only exists once the
+        # entries depending on it do
+        for entry, cache in queued:
+            writer.save(entry, last=entry is image_entry)
+            if cache is not None:
+                writer.after_flush(functools.partial(cache.put, entry))
+        writer.after_flush(functools.partial(
+            _delete_object, s3_object.bucket_name, s3_object.key))
+
+    return IngestedImage(
+        s3_object=new_key,
+        metadata=image_entry,
+        checksum=checksum,
+        etag=etag,
+        width=size[0],
+        height=size[1],
+        duplicate=duplicate)
+
+
+def _fit_size(size, box):
+    """
+    Returns the dimensions of an image scaled down to fit within a box
+
+    Mirrors the aspect-preserving arithmetic of ``Image.thumbnail`` and never
+    scales an image up.
 
-    return new_key, image_entry
+    :param size: Width & height of the source image
+    :type size: tuple
+    :param box: Maximum width & height
+    :type box: tuple
+    :returns: Width & height of the scaled image
+    :rtype: tuple
+    """
+    x, y = size
+    width, height = box
+
+    if x > width:
+        y = max(int(round(y * width / x)), 1)
+        x = width
 
+    if y > height:
+        x = max(int(round(x * height / y)), 1)
+        y = height
 
-def create_thumbnail(s3_object, thumbnail_prefix, width, height):
+    return x, y
+
+
+def _thumbnail_key(thumbnail_prefix, width, height, key):
     """
-    Creates a thumbnail image
+    Returns the S3 key of a thumbnail rendition
 
-    :param s3_object: New photo in S3
-    :type s3_object: boto3.resources.factory.s3.Object
     :param thumbnail_prefix: S3 key prefix for thumbnails
     :type thumbnail_prefix: str
     :param width: Maximum width
     :type width: int
     :param height: Maximum height
     :type height: int
+    :param key: S3 key of the original image
+    :type key: str
+    :rtype: str
     """
-    tmp_filename, img = _get_image_from_s3(s3_object)
-
-    try:
-        os.remove(tmp_filename)
-    except Exception:
-        # Ignore the inability to remove the file
-        pass
-
-    # Perform thumbnail creation and re-save file
-    img.thumbnail([width, height], Image.ANTIALIAS)
-    img.save(tmp_filename)
-
-    # Push the thumbnail into S3
-    s3_thumbnail = s3_object.Bucket().Object("{p}/{x}x{y}/{f}".format(
+    return "{p}/{x}x{y}/{f}".format(
         p=thumbnail_prefix,
         x=width,
         y=height,
-        f=os.path.basename(s3_object.key)))
+        f=os.path.basename(key))
+
+
+def render_thumbnails(img, sizes):
+    """
+    Renders every requested thumbnail size from a single decoded image
+
+    Sizes are rendered largest to smallest. Each rendition is resampled from
+    the smallest image produced so far that still covers it, falling back to
+    the original when no earlier rendition is large enough (e.g. a portrait
+    box following a landscape one).
+
+    Renditions are yielded as they are rendered, and images no remaining
+    size would be resampled from (the original included) are let go of, so
+    only a few are ever held at once. The caller should drop its own
+    reference to ``img`` once iterating.
 
-    s3_thumbnail.upload_file(tmp_filename)
+    :param img: PIL image
+    :param sizes: Maximum width & height of each rendition
+    :type sizes: list
+    :returns: Each requested (width, height) & its PIL image
+    :rtype: generator
+    """
+    from PIL import Image
+
+    img.load()
+
+    boxes = sorted(
+        ((tuple(box), _fit_size(img.size, box)) for box in sizes),
+        key=lambda item: item[1][0] * item[1][1],
+        reverse=True)
+    sources = [img]
+    del img
+
+    def source_for(target):
+        # Smallest image so far covering the target
+        return min(
+            (s for s in sources
+             if s.size[0] >= target[0] and s.size[1] >= target[1]),
+            key=lambda s: s.size[0] * s.size[1])
+
+    for n, (box, target) in enumerate(boxes):
+        source = source_for(target)
+
+        if source.size == target:
+            rendition = source
+        else:
+            rendition = source.resize(target, Image.LANCZOS)
+            sources.append(rendition)
+
+        # Keep only what the remaining sizes will be resampled from
+        needed = [source_for(t) for _, t in boxes[n + 1:]]
+        sources = [s for s in sources if any(s is u for u in needed)]
+        source = needed = None
+
+        yield box, rendition
+
+
+def reduce_for_sizes(img, sizes):
+    """
+    Returns a smaller source image that still covers every size
+
+    Only JPEGs (and MPOs, which hold JPEGs) are decoded at a reduced scale:
+    draft mode lets the decoder apply 1/2, 1/4 or 1/8 DCT scaling, which
+    saves both decoding time and memory, and must be asked for before the
+    image data has been loaded. Other formats are still decoded at full
+    resolution, then reduced by the largest integer factor that keeps the
+    image at least as large as the biggest rendition. That only makes a
+    cheaper source for resizing each rendition from.
+
+    :param img: Unloaded PIL image
+    :param sizes: Maximum width & height of each rendition
+    :type sizes: list
+    :returns: PIL image, possibly at a reduced resolution
+    """
+    from PIL import JpegImagePlugin
+
+    targets = [_fit_size(img.size, box) for box in sizes]
+    width = max(target[0] for target in targets)
+    height = max(target[1] for target in targets)
+
+    # Covers the JPEG based formats too, such as MPO
+    if isinstance(img, JpegImagePlugin.JpegImageFile):
+        img.draft(img.mode, (width, height))
+        return img
+
+    factor = min(img.size[0] // width, img.size[1] // height)
+    if factor > 1 and img.mode not in ('1', 'P') and hasattr(img, 'reduce'):
+        return img.reduce(factor)
+
+    return img
+
+
+def create_thumbnails(s3_object, thumbnail_prefix, sizes,
+                      reduced_decode=True, etag=None):
+    """
+    Creates thumbnail images of several sizes from one download & decode
+
+    :param s3_object: New photo in S3
+    :type s3_object: boto3.resources.factory.s3.Object
+    :param thumbnail_prefix: S3 key prefix for thumbnails
+    :type thumbnail_prefix: str
+    :param sizes: Maximum width & height of each thumbnail
+    :type sizes: list
+    :param reduced_decode: Resize from the smallest scale covering all
+        sizes rather than from full resolution, see
+        :func:`reduce_for_sizes`
+    :type reduced_decode: bool
+    :param etag: Expected ETag of the original, if known
+    :type etag: str
+    """
+    buf, img = _get_image_from_s3(s3_object, etag=etag)
+
+    with buf:
+        img_format = img.format
+
+        if reduced_decode:
+            img = reduce_for_sizes(img, sizes)
+
+        # Decode before the download is let go of
+        img.load()
+
+    # Each rendition is uploaded as soon as it is rendered, so only the
+    # images still needed to render the rest are held at once
+    renditions = render_thumbnails(img, sizes)
+    img = None
+
+    for (width, height), rendition in renditions:
+        # Encode the rendition in memory & push it into S3
+        thumbnail_buf = io.BytesIO()
+        rendition.save(thumbnail_buf, format=img_format)
+        thumbnail_buf.seek(0)
+
+        s3_thumbnail = s3_object.Bucket().Object(
+            _thumbnail_key(thumbnail_prefix, width, height, s3_object.key))
+
+        s3_thumbnail.upload_fileobj(thumbnail_buf)
+
+
+def create_thumbnail(s3_object, thumbnail_prefix, width, height,
+                     reduced_decode=True):
+    """
+    Creates a thumbnail image
+
+    :param s3_object: New photo in S3
+    :type s3_object: boto3.resources.factory.s3.Object
+    :param thumbnail_prefix: S3 key prefix for thumbnails
+    :type thumbnail_prefix: str
+    :param width: Maximum width
+    :type width: int
+    :param height: Maximum height
+    :type height: int
+    :param reduced_decode: Resize from the smallest scale covering the
+        size, see :func:`reduce_for_sizes`
+    :type reduced_decode: bool
+    """
+    create_thumbnails(s3_object, thumbnail_prefix, [(width, height)],
+                      reduced_decode=reduced_decode)
@@ -4,7 +4,7 @@ photos3.lambda
 
 """
 from __future__ import print_function
-import boto3
+import concurrent.futures
 import json
 import os
 import sys
@@ -14,8 +14,15 @@ import urllib
 
 from botocore.exceptions import ClientError
 
-from photos3.imgprocess import create_thumbnail
-from photos3.imgprocess import ingest_image
+from photos3 import clients
+from photos3.fanout import pack_thumbnail_requests
+from photos3.fanout import publish_thumbnail_requests
+from photos3.fanout import thumbnail_request
+from photos3.heartbeat import VisibilityHeartbeat
+from photos3.metrics import emit
+from photos3.scheduling import CostEstimator
+from photos3.scheduling import DrainController
+from photos3.scheduling import TimeBudget
 
 
 #################
@@ -39,12 +46,244 @@ THUMBNAIL_SIZES = [
     (2732, 2048), # iPad Pro
 ]
 
+# How thumbnail generation is requested for each new image:
+#   pyramid - One message; the original is decoded once for every size
+#   single  - One message per size
+THUMBNAIL_DISPATCH = os.environ.get('THUMBNAIL_DISPATCH', 'pyramid')
+
+# Most images rendered by a single thumbnail worker invocation. Requests for
+# a whole receive batch are published together regardless.
+THUMBNAIL_IMAGES_PER_MESSAGE = int(os.environ.get(
+    'THUMBNAIL_IMAGES_PER_MESSAGE', 1))
+
+# Number of images ingested concurrently by each invocation
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 4))
+
+# Queue backlog each drain worker started by the controller should handle,
+# and the most drain workers to have running at once
+DRAIN_MESSAGES_PER_WORKER = int(os.environ.get('DRAIN_MESSAGES_PER_WORKER',
+                                               50))
+DRAIN_MAX_WORKERS = int(os.environ.get('DRAIN_MAX_WORKERS', 10))
+
+# Write the database entries of each received batch of images together
+# rather than one at a time
+INGEST_BATCH_WRITES = os.environ.get('INGEST_BATCH_WRITES',
+                                     'true').lower() == 'true'
+
+# Attempts at a record whose message partially failed before it is sent
+# to DEAD_LETTER_QUEUE, or dropped when there is none. Messages whose records
+# all fail are left to the queue's own redrive policy.
+INGEST_MAX_ATTEMPTS = int(os.environ.get('INGEST_MAX_ATTEMPTS', 5))
+
+# Seconds each visibility heartbeat keeps in-flight messages hidden for
+VISIBILITY_HEARTBEAT_TIMEOUT = int(os.environ.get(
+    'VISIBILITY_HEARTBEAT_TIMEOUT', 60))
+
+# Seconds each invocation keeps back for receiving, publishing & cleaning up
+# once it stops taking on new images
+INGEST_TIME_RESERVE = float(os.environ.get('INGEST_TIME_RESERVE', 20))
+
+# How new images are read during ingestion:
+#   full     - The whole object is buffered, hashed & its header decoded
+#   metadata - Metadata comes from a leading byte range; the body is only
+#              streamed through the checksum
+INGEST_MODE = os.environ.get('INGEST_MODE', 'full')
+
+# Resize thumbnails from the smallest scale covering them: JPEGs are decoded
+# at that scale, other formats reduced by an integer factor once decoded.
+# Set to 'false' to always resize from full resolution.
+THUMBNAIL_REDUCED_DECODE = os.environ.get(
+    'THUMBNAIL_REDUCED_DECODE', 'true').lower() == 'true'
+
+# Recent per-image ingest times, kept for the life of the container
+INGEST_COSTS = CostEstimator()
+
+# Threads ingesting images, kept for the life of the container along with
+# the boto3 sessions & resources each of them creates
+_ingest_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=INGEST_WORKERS)
+
 ##############################
 # Amazon Service Definitions #
 ##############################
-s3  = boto3.resource('s3')
-sns = boto3.client('sns')
-sqs = boto3.resource('sqs')
+# Clients & resources come from photos3.clients, which only creates them on
+# first use and then caches them: clients for the life of the container and
+# resources for the life of the thread using them, which for the pools held
+# at module level is that of the container too. Handlers
+# likewise import PIL & pynamodb (via photos3.imgprocess & photos3.model)
+# only when they actually need them.
+
+
+def _ingest_record(record, original_prefix, upload_prefix, writer=None):
+    """
+    Ingests the S3 object named by one S3 Event Notification record
+
+    Runs on an ingest pool thread, using the shared clients and that
+    thread's own resources.
+
+    :param record: S3 Event Notification record
+    :type record: dict
+    :param original_prefix: S3 key prefix for original images
+    :type original_prefix: str
+    :param upload_prefix: S3 key prefix for uploaded images
+    :type upload_prefix: str
+    :param writer: Batch to queue database writes in
+    :type writer: photos3.model.WriteBatch
+    :returns: Ingested image, or None if it was already processed
+    :rtype: photos3.imgprocess.IngestedImage
+    """
+    from photos3.imgprocess import ingest_image
+
+    # Fetch the S3 bucket and object
+    s3_bucket = clients.resource('s3').Bucket(record['s3']['bucket']['name'])
+    s3_object = s3_bucket.Object(urllib.parse.unquote_plus(record['s3']['object']['key']))
+
+    try:
+        # Find file size
+        s3_object_size = s3_object.content_length
+    except ClientError as e:
+        # Ignore 404s. This image was already processed
+        if str(e.response['Error']['Code']) == '404':
+            return None
+        else:
+            raise
+
+    # TODO Do not process objects over a certain size
+
+    print("Processing s3://{b}/{k} ({s} bytes)".format(
+        b=s3_object.bucket_name,
+        k=s3_object.key,
+        s=s3_object_size,
+    ))
+
+    # Ingest the image
+    return ingest_image(s3_object,
+                        original_prefix,
+                        upload_prefix,
+                        metadata_first=(INGEST_MODE == 'metadata'),
+                        writer=writer)
+
+
+def _delete_messages(queue, messages):
+    """
+    Removes messages from a queue, up to 10 per request
+
+    :param queue: SQS queue
+    :type queue: boto3.resources.factory.sqs.Queue
+    :param messages: Messages to remove
+    :type messages: list
+    """
+    for i in range(0, len(messages), 10):
+        batch = messages[i:i + 10]
+        print("Removing {} queue messages".format(len(batch)))
+
+        response = queue.delete_messages(Entries=[
+            {
+                'Id': str(n),
+                'ReceiptHandle': msg_obj.receipt_handle,
+            }
+            for n, msg_obj in enumerate(batch)
+        ])
+
+        for failure in response.get('Failed', []):
+            print("Failed to remove queue message: {}".format(failure))
+
+
+def _requeue_records(queue, records, attempts):
+    """
+    Writes failed records back to the queue as a new S3 Event Notification
+
+    A new message starts SQS's receive count over, so the message carries
+    the number of attempts made at its records as ``Attempts``. Records that
+    have had ``INGEST_MAX_ATTEMPTS`` go to ``DEAD_LETTER_QUEUE`` instead, or
+    are dropped when there is none.
+
+    :param queue: SQS queue
+    :type queue: boto3.resources.factory.sqs.Queue
+    :param records: S3 Event Notification records to retry
+    :type records: list
+    :param attempts: Attempts made at the records so far
+    :type attempts: int
+    """
+    body = json.dumps({'Records': records, 'Attempts': attempts + 1})
+
+    if attempts < INGEST_MAX_ATTEMPTS:
+        print("Requeueing {} failed records".format(len(records)))
+        queue.send_message(MessageBody=body)
+        return
+
+    dead_letter_queue = os.environ.get('DEAD_LETTER_QUEUE')
+    if not dead_letter_queue:
+        print("Dropping {n} records after {a} attempts: {r}".format(
+            n=len(records),
+            a=attempts,
+            r=json.dumps(records)))
+        return
+
+    print("Dead-lettering {n} records after {a} attempts".format(
+        n=len(records),
+        a=attempts))
+    clients.resource('sqs').get_queue_by_name(
+        QueueName=dead_letter_queue).send_message(MessageBody=body)
+
+
+def _hand_off(queue, event, context, thumbnail_requests=None):
+    """
+    Starts a fresh invocation to carry on draining a queue with a backlog
+
+    :param queue: SQS queue
+    :type queue: boto3.resources.factory.sqs.Queue
+    :param event: Event this invocation was started with
+    :type event: dict
+    :param context: Lambda context
+    :param thumbnail_requests: Rendition specs that could not be published,
+        for the fresh invocation to publish. It is started for them even
+        when the queue is empty.
+    :type thumbnail_requests: list
+    """
+    queue.load()
+    backlog = int(queue.attributes.get('ApproximateNumberOfMessages', 0))
+    if not backlog and not thumbnail_requests:
+        return
+
+    event = dict(event)
+    event['THUMBNAIL_REQUESTS'] = thumbnail_requests or []
+
+    print("Handing off {b} queued messages & {t} thumbnail requests".format(
+        b=backlog,
+        t=len(event['THUMBNAIL_REQUESTS'])))
+    clients.client('lambda').invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType='Event',
+        Payload=json.dumps(event))
+
+
+def _publish_thumbnail_requests(requests):
+    """
+    Requests thumbnail generation, reporting rather than raising failures
+
+    Publishing is retried as a whole, so images whose requests did go out
+    may have their thumbnails rendered twice, which is harmless.
+
+    :param requests: Rendition specs
+    :type requests: list
+    :returns: Whether every request was published
+    :rtype: bool
+    """
+    try:
+        publish_thumbnail_requests(
+            clients.client('sns'),
+            os.environ.get('THUMBNAIL_TOPIC'),
+            pack_thumbnail_requests(
+                requests,
+                images_per_message=THUMBNAIL_IMAGES_PER_MESSAGE,
+                sizes_per_message=(1 if THUMBNAIL_DISPATCH == 'single'
+                                   else None)))
+        return True
+
+    except Exception as e:
+        traceback.print_exception(*sys.exc_info())
+        return False
 
 
 def process_new_image_queue(event, context):
@@ -53,7 +292,20 @@ def process_new_image_queue(event, context):
 
     This implicitly takes advantage of the LACK OF long polling to reduce
     runtime given that image uploads are typically few-and-far-between.
+
+    Up to 10 messages are received at a time and their records ingested
+    concurrently by ``INGEST_WORKERS`` threads, with their database entries
+    written in one batch before any message is let go of. No more messages
+    are taken on than recent per-image times say will finish before the
+    Lambda times out; any backlog left at that point is handed to a fresh
+    invocation.
+
+    Uploads are removed before thumbnails are requested, so requests that
+    fail to publish are retried along with the next batch's and, failing
+    that, handed to a fresh invocation as ``THUMBNAIL_REQUESTS``.
     """
+    from photos3.model import WriteBatch
+
     task_queue_name = event.get('TASK_QUEUE',
                                 os.environ.get('TASK_QUEUE'))
     original_prefix = event.get('S3_PREFIX_ORIGINAL',
@@ -62,108 +314,246 @@ def process_new_image_queue(event, context):
                               os.environ.get('S3_PREFIX_UPLOAD'))
 
     print("Reading from {}".format(task_queue_name))
-    new_image_queue = sqs.get_queue_by_name(QueueName=task_queue_name)
+    new_image_queue = clients.resource('sqs').get_queue_by_name(
+        QueueName=task_queue_name)
 
-    has_messages = True
-    while has_messages:
-        # Assume there are no messages in the queue, letting the Lambda
-        # conclude, unless a message is received
-        has_messages = False
+    ingested_images = 0
+    duplicate_images = 0
+    failed_images = 0
 
-        for msg_obj in new_image_queue.receive_messages(WaitTimeSeconds=5):
-            # Indicate that a message was received during this iteration
-            has_messages = True
+    # Rendition specs still to be published, possibly left over from an
+    # earlier invocation
+    unpublished = list(event.get('THUMBNAIL_REQUESTS', []))
 
-            # Decode S3 Event Notification received by SQS
-            s3_msg = json.loads(msg_obj.body)
+    budget = TimeBudget(context, INGEST_COSTS, reserve=INGEST_TIME_RESERVE)
+    out_of_time = False
 
-            # Iterate through each record of the S3 Event Notifications
-            # There's likely only one record per event, but we should still
-            # iterate through the list.
-            failed_objects = 0
+    heartbeat = VisibilityHeartbeat(new_image_queue.url,
+                                    timeout=VISIBILITY_HEARTBEAT_TIMEOUT)
+    heartbeat.start()
 
-            for record in s3_msg['Records']:
-                # Fetch the S3 bucket and object
-                s3_bucket = s3.Bucket(record['s3']['bucket']['name'])
-                s3_object = s3_bucket.Object(urllib.parse.unquote_plus(record['s3']['object']['key']))
+    try:
+        has_messages = True
+        while has_messages:
+            # Only take on as many images as there is time left for
+            capacity = min(budget.capacity(INGEST_WORKERS), 10)
+            if capacity < 1:
+                out_of_time = True
+                break
 
-                try:
-                    # Find file size
-                    s3_object_size = s3_object.content_length
-                except ClientError as e:
-                    # Ignore 404s. This image was already processed
-                    if str(e.response['Error']['Code']) == '404':
+            messages = new_image_queue.receive_messages(
+                MaxNumberOfMessages=capacity,
+                WaitTimeSeconds=5)
+
+            # Let the Lambda conclude once no message is received
+            has_messages = bool(messages)
+
+            # Keep the messages from reappearing while they're being processed
+            heartbeat.add(messages)
+
+            writer = WriteBatch() if INGEST_BATCH_WRITES else None
+
+            # Decode the S3 Event Notifications received by SQS and ingest
+            # each of their records. There's likely only one record per event,
+            # but we should still iterate through the list.
+            pending = []
+            for msg_obj in messages:
+                body = json.loads(msg_obj.body)
+                pending.append((msg_obj, body.get('Attempts', 1), [
+                    (record, _ingest_pool.submit(INGEST_COSTS.timed,
+                                                 _ingest_record,
+                                                 record,
+                                                 original_prefix,
+                                                 upload_prefix,
+                                                 writer))
+                    for record in body.get('Records', [])
+                ]))
+
+            # Rendition specs for every image ingested from this batch, the
+            # messages that are done with and the records of partially failed
+            # messages that need another attempt
+            thumbnail_requests = []
+            completed_messages = []
+            failed_records = []
+            batch_ingested = batch_duplicates = 0
+
+            for msg_obj, attempts, futures in pending:
+                failed = []
+
+                for record, future in futures:
+                    try:
+                        ingested = future.result()
+
+                    except Exception as e:
+                        # Report the failure
+                        failed.append(record)
+                        traceback.print_exception(*sys.exc_info())
+                        continue
+
+                    if ingested is None:
+                        continue
+
+                    batch_ingested += 1
+
+                    # Duplicates already have their thumbnails
+                    if ingested.duplicate:
+                        batch_duplicates += 1
                         continue
-                    else:
-                        raise
 
-                # TODO Do not process objects over a certain size
+                    thumbnail_requests.append(
+                        thumbnail_request(ingested, THUMBNAIL_SIZES))
 
-                print("Processing s3://{b}/{k} ({s} bytes)".format(
-                    b=s3_object.bucket_name,
-                    k=s3_object.key,
-                    s=s3_object_size,
-                ))
+                failed_images += len(failed)
 
-                # Ingest the image
+                # A message whose records all failed is left to become visible
+                # again. Otherwise only its failed records are retried.
+                if not failed or len(failed) < len(futures):
+                    completed_messages.append(msg_obj)
+                    if failed:
+                        failed_records.append((failed, attempts))
+
+            # Write the batch's database entries (and only then remove its
+            # uploads) before anything depends on them. Should that fail,
+            # every message of the batch is left to become visible again.
+            if writer is not None:
                 try:
-                    s3_object, image_meta_data = ingest_image(s3_object,
-                                                              original_prefix,
-                                                              upload_prefix)
+                    writer.flush()
 
                 except Exception as e:
-                    # Report the failure
-                    failed_objects += 1
                     traceback.print_exception(*sys.exc_info())
-                    continue
-
-                # Request thumbnail generation
-                # Ref: https://stackoverflow.com/a/37009414
-                for thumbspec in THUMBNAIL_SIZES:
-                    message = {
-                        's3_bucket': s3_object.bucket_name,
-                        's3_key': s3_object.key,
-                        'width': thumbspec[0],
-                        'height': thumbspec[1],
-                    }
-                    sns.publish(
-                        TopicArn=os.environ.get('THUMBNAIL_TOPIC'),
-                        Message=json.dumps({'default': json.dumps(message)}),
-                        MessageStructure='json')
-
-            if not failed_objects:
-                print("Removing queue message")
-                msg_obj.delete()
+                    failed_images += batch_ingested
+                    batch_ingested = batch_duplicates = 0
+                    thumbnail_requests = []
+                    completed_messages = []
+                    failed_records = []
+
+            ingested_images += batch_ingested
+            duplicate_images += batch_duplicates
+
+            # Request thumbnail generation for the whole batch before letting
+            # go of any of its messages. Their uploads are already gone, so
+            # failed requests are kept to be tried again rather than left to
+            # the messages.
+            # Ref: https://stackoverflow.com/a/37009414
+            thumbnail_requests = unpublished + thumbnail_requests
+            if thumbnail_requests and \
+                    not _publish_thumbnail_requests(thumbnail_requests):
+                unpublished = thumbnail_requests
+            else:
+                unpublished = []
+
+            heartbeat.discard(messages)
+
+            for records, attempts in failed_records:
+                _requeue_records(new_image_queue, records, attempts)
+
+            _delete_messages(new_image_queue, completed_messages)
+
+    finally:
+        heartbeat.stop()
+
+    if unpublished and _publish_thumbnail_requests(unpublished):
+        unpublished = []
+
+    if out_of_time or unpublished:
+        _hand_off(new_image_queue, event, context,
+                  thumbnail_requests=unpublished)
+
+    emit({
+        'ImagesIngested': ingested_images,
+        'DuplicateImages': duplicate_images,
+        'FailedImages': failed_images,
+        'UnpublishedThumbnailRequests': len(unpublished),
+    }, dimensions={'Function': 'process_new_image_queue'})
+
+
+def scale_new_image_workers(event, context):
+    """
+    Invoked by a schedule to start queue drain workers
+
+    Reads the depth of the new image queue and asynchronously invokes
+    ``process_new_image_queue`` in proportion to it, up to
+    ``DRAIN_MAX_WORKERS`` at once. An empty queue costs a single attribute
+    lookup.
+    """
+    task_queue_name = event.get('TASK_QUEUE',
+                                os.environ.get('TASK_QUEUE'))
+    worker_function = event.get('WORKER_FUNCTION',
+                                os.environ.get('WORKER_FUNCTION'))
+
+    new_image_queue = clients.resource('sqs').get_queue_by_name(
+        QueueName=task_queue_name)
+
+    def start_worker():
+        clients.client('lambda').invoke(
+            FunctionName=worker_function,
+            InvocationType='Event',
+            Payload=json.dumps({}))
+
+    workers = DrainController(new_image_queue,
+                              start_worker,
+                              per_worker=DRAIN_MESSAGES_PER_WORKER,
+                              ceiling=DRAIN_MAX_WORKERS).run()
+
+    emit({
+        'DrainWorkersStarted': workers,
+    }, dimensions={'Function': 'scale_new_image_workers'})
 
 
 def process_thumbnail(event, context):
     """
     Invoked by the initial image processing Lambda
     """
+    from photos3.imgprocess import create_thumbnails
+    from photos3.model import ImageSummary
+
     thumbnail_prefix = event.get('S3_PREFIX_THUMBNAIL',
                                  os.environ.get('S3_PREFIX_THUMBNAIL'))
 
+    failed_objects = 0
+
     for record in event['Records']:
-        # Read in the SNS message and determine the source S3 object
+        # Read in the SNS message, which either carries a batch of images or
+        # (from older publishers) a single image
         sns_data = json.loads(record['Sns']['Message'])
-        s3_object = s3.Object(sns_data['s3_bucket'], sns_data['s3_key'])
-        width = int(sns_data['width'])
-        height = int(sns_data['height'])
-
-        print("Generating {w}x{h} for s3://{b}/{k}".format(
-            w=width,
-            h=height,
-            b=s3_object.bucket_name,
-            k=s3_object.key))
-
-        # Generate the thumbnail
-        try:
-            create_thumbnail(s3_object, thumbnail_prefix, width, height)
-
-        except Exception as e:
-            # Report the failure
-            failed_objects += 1
-            traceback.print_exception(*sys.exc_info())
+
+        for image in sns_data.get('images', [sns_data]):
+            s3_object = clients.resource('s3').Object(image['s3_bucket'],
+                                                      image['s3_key'])
+
+            if 'sizes' in image:
+                sizes = [(int(w), int(h)) for w, h in image['sizes']]
+            else:
+                sizes = [(int(image['width']), int(image['height']))]
+
+            print("Generating {s} for s3://{b}/{k}".format(
+                s=", ".join("{}x{}".format(w, h) for w, h in sizes),
+                b=s3_object.bucket_name,
+                k=s3_object.key))
+
+            # Generate the thumbnails
+            try:
+                create_thumbnails(s3_object, thumbnail_prefix, sizes,
+                                  reduced_decode=THUMBNAIL_REDUCED_DECODE,
+                                  etag=image.get('etag'))
+
+                # Let listings know the thumbnails exist. Older publishers
+                # don't say which image they are of.
+                if image.get('checksum'):
+                    ImageSummary.add_renditions(image['checksum'], sizes)
+
+            except Exception as e:
+                # Report the failure
+                failed_objects += 1
+                traceback.print_exception(*sys.exc_info())
+
+    if failed_objects:
+        print("Failed to generate thumbnails for {} images".format(
+            failed_objects))
+
+    emit({
+        'FailedThumbnails': failed_objects,
+    }, dimensions={'Function': 'process_thumbnail'})
 
 
 if __name__ == '__main__':
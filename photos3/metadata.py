@@ -0,0 +1,522 @@
+"""
+photos3.metadata
+================
+Contains code for reading image metadata straight from file headers
+
+JPEG APP segments, TIFF IFDs and PNG/WebP chunks are walked directly from a
+buffer, stopping at the first image data, so no pixels are ever decoded.
+Values keep their EXIF types: integers, floats for rationals, text for ASCII
+and bytes for undefined data.
+"""
+import struct
+import zlib
+
+from PIL.ExifTags import GPSTAGS
+from PIL.ExifTags import TAGS
+
+
+# TIFF tags pointing at sub-IFDs
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+INTEROP_IFD = 0xA005
+
+# TIFF field types: struct format & size of a single value
+FIELD_TYPES = {
+    1: ('B', 1),    # BYTE
+    2: ('s', 1),    # ASCII
+    3: ('H', 2),    # SHORT
+    4: ('L', 4),    # LONG
+    5: ('LL', 8),   # RATIONAL
+    6: ('b', 1),    # SBYTE
+    7: ('s', 1),    # UNDEFINED
+    8: ('h', 2),    # SSHORT
+    9: ('l', 4),    # SLONG
+    10: ('ll', 8),  # SRATIONAL
+    11: ('f', 4),   # FLOAT
+    12: ('d', 8),   # DOUBLE
+    13: ('L', 4),   # IFD
+}
+
+# JPEG start-of-frame markers carrying the image dimensions
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Most bytes a compressed PNG chunk may decompress to, as with PIL
+MAX_TEXT_CHUNK = 1024 * 1024
+
+
+class UnknownFormat(ValueError):
+    """
+    The buffer does not hold a supported image format
+    """
+
+
+class HeaderTruncated(Exception):
+    """
+    The header continues past the end of the buffer
+
+    :ivar needed: Number of leading bytes required to continue parsing
+    """
+    def __init__(self, needed):
+        super(HeaderTruncated, self).__init__(
+            "Header needs at least {} bytes".format(needed))
+        self.needed = needed
+
+
+def _require(data, end):
+    """
+    Raises :class:`HeaderTruncated` unless ``data`` extends to ``end``
+    """
+    if end > len(data):
+        raise HeaderTruncated(end)
+
+
+def _text(value):
+    """
+    Decodes a NUL-terminated string field
+    """
+    return value.split(b'\x00', 1)[0].decode('utf-8', 'replace').strip()
+
+
+def _field_value(field_type, raw, count, order):
+    """
+    Unpacks the value of a TIFF field
+
+    :returns: A single value when ``count`` is 1, otherwise a tuple
+    """
+    if field_type == 2:
+        return _text(raw)
+    if field_type == 7:
+        return raw
+
+    fmt, size = FIELD_TYPES[field_type]
+    values = struct.unpack(order + fmt * count, raw[:size * count])
+
+    if field_type in (5, 10):
+        values = tuple(
+            float(num) / den if den else None
+            for num, den in zip(values[::2], values[1::2]))
+
+    if count == 1:
+        return values[0]
+    return values
+
+
+def _read_ifd(data, base, offset, order, names, visited):
+    """
+    Reads one TIFF IFD into a dict of named values
+
+    :param data: Buffer holding the TIFF structure
+    :param base: Position of the TIFF header within ``data``
+    :param offset: Offset of the IFD from the TIFF header
+    :param order: struct byte order character
+    :param names: Mapping of tag numbers to names
+    :param visited: Offsets of IFDs already read, to break loops
+    :returns: Tuple of named values, sub-IFD offsets & next IFD offset
+    """
+    if offset in visited:
+        return {}, {}, 0
+    visited.add(offset)
+
+    start = base + offset
+    _require(data, start + 2)
+    entry_count, = struct.unpack(order + 'H', data[start:start + 2])
+    _require(data, start + 2 + entry_count * 12 + 4)
+
+    values = {}
+    sub_ifds = {}
+    for i in range(entry_count):
+        entry = start + 2 + i * 12
+        tag, field_type, count = struct.unpack(order + 'HHL',
+                                               data[entry:entry + 8])
+
+        if field_type not in FIELD_TYPES:
+            continue
+
+        if tag in (EXIF_IFD, GPS_IFD, INTEROP_IFD):
+            sub_ifds[tag], = struct.unpack(order + 'L',
+                                           data[entry + 8:entry + 12])
+            continue
+
+        size = FIELD_TYPES[field_type][1] * count
+        if size <= 4:
+            raw = data[entry + 8:entry + 8 + size]
+        else:
+            value_offset, = struct.unpack(order + 'L',
+                                          data[entry + 8:entry + 12])
+            _require(data, base + value_offset + size)
+            raw = data[base + value_offset:base + value_offset + size]
+
+        values[names.get(tag, tag)] = _field_value(field_type, raw, count,
+                                                   order)
+
+    next_start = start + 2 + entry_count * 12
+    next_offset, = struct.unpack(order + 'L', data[next_start:next_start + 4])
+
+    return values, sub_ifds, next_offset
+
+
+def _gps_degrees(value, ref):
+    """
+    Converts a degrees/minutes/seconds triple into signed decimal degrees
+    """
+    if not isinstance(value, (tuple, list)) or None in value:
+        return None
+
+    degrees = sum(part / 60 ** i for i, part in enumerate(value))
+    if ref in ('S', 'W'):
+        degrees = -degrees
+    return degrees
+
+
+def parse_tiff(data, base=0):
+    """
+    Parses a TIFF structure, as found in TIFF files & EXIF segments
+
+    :param data: Buffer holding the TIFF structure
+    :type data: bytes
+    :param base: Position of the TIFF header within ``data``
+    :type base: int
+    :returns: Tuple of IFD0 & Exif IFD values and GPS IFD values
+    :rtype: tuple
+    """
+    _require(data, base + 8)
+    byte_order = data[base:base + 2]
+    if byte_order == b'II':
+        order = '<'
+    elif byte_order == b'MM':
+        order = '>'
+    else:
+        raise UnknownFormat("Invalid TIFF byte order")
+
+    magic, ifd_offset = struct.unpack(order + 'HL', data[base + 2:base + 8])
+    if magic != 42:
+        raise UnknownFormat("Invalid TIFF header")
+
+    visited = set()
+    exif, sub_ifds, _ = _read_ifd(data, base, ifd_offset, order, TAGS,
+                                  visited)
+
+    gps = {}
+    if EXIF_IFD in sub_ifds:
+        values, _, _ = _read_ifd(data, base, sub_ifds[EXIF_IFD], order, TAGS,
+                                 visited)
+        exif.update(values)
+
+    if GPS_IFD in sub_ifds:
+        gps, _, _ = _read_ifd(data, base, sub_ifds[GPS_IFD], order, GPSTAGS,
+                              visited)
+
+    return exif, gps
+
+
+def _parse_jpeg(data, header):
+    """
+    Walks JPEG markers up to the start of scan
+    """
+    icc_chunks = {}
+    pos = 2
+
+    while True:
+        _require(data, pos + 4)
+        if data[pos] != 0xFF:
+            raise UnknownFormat("Invalid JPEG marker at {}".format(pos))
+
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # Markers without a payload
+            pos += 2
+            continue
+
+        if marker in (0xD9, 0xDA):
+            # End of image or start of scan; image data follows
+            break
+
+        length, = struct.unpack('>H', data[pos + 2:pos + 4])
+        segment_start = pos + 4
+        segment_end = pos + 2 + length
+        _require(data, segment_end)
+        segment = data[segment_start:segment_end]
+
+        if marker in SOF_MARKERS and len(segment) >= 6:
+            header['height'], header['width'] = struct.unpack(
+                '>HH', segment[1:5])
+            header['info']['bits'] = segment[0]
+            header['info']['components'] = segment[5]
+            header['info']['progressive'] = marker in (0xC2, 0xC6, 0xCA,
+                                                       0xCE)
+
+        elif marker == 0xE0 and segment.startswith(b'JFIF\x00') and \
+                len(segment) >= 12:
+            major, minor, unit, x_density, y_density = struct.unpack(
+                '>BBBHH', segment[5:12])
+            header['info']['jfif_version'] = (major, minor)
+            if unit == 1:
+                header['info']['dpi'] = (x_density, y_density)
+
+        elif marker == 0xE1 and segment.startswith(b'Exif\x00\x00'):
+            tiff = segment[6:]
+            try:
+                exif, gps = parse_tiff(tiff)
+            except HeaderTruncated:
+                # The segment length is known, so this is a corrupt IFD
+                # rather than a short read
+                exif, gps = {}, {}
+            header['exif'].update(exif)
+            header['gps'].update(gps)
+
+        elif marker == 0xE2 and segment.startswith(b'ICC_PROFILE\x00') and \
+                len(segment) >= 14:
+            icc_chunks[segment[12]] = segment[14:]
+
+        elif marker == 0xFE:
+            header['info']['comment'] = segment.decode('utf-8', 'replace')
+
+        pos = segment_end
+
+    if icc_chunks:
+        header['info']['icc_profile'] = b''.join(
+            icc_chunks[i] for i in sorted(icc_chunks))
+
+
+def _decompress(data):
+    """
+    Returns the contents of a compressed PNG chunk, or None if they are
+    corrupt or larger than ``MAX_TEXT_CHUNK``
+    """
+    decompressor = zlib.decompressobj()
+    try:
+        value = decompressor.decompress(data, MAX_TEXT_CHUNK)
+    except zlib.error:
+        return None
+
+    if decompressor.unconsumed_tail:
+        return None
+    return value
+
+
+def _parse_png(data, header):
+    """
+    Walks PNG chunks up to the first image data
+
+    Chunks too short for their fields, or whose compressed contents are
+    corrupt or too large, are skipped as PIL does.
+    """
+    pos = len(PNG_SIGNATURE)
+
+    while True:
+        _require(data, pos + 8)
+        length, chunk_type = struct.unpack('>L4s', data[pos:pos + 8])
+
+        if chunk_type in (b'IDAT', b'IEND'):
+            break
+
+        chunk_start = pos + 8
+        chunk_end = chunk_start + length
+        _require(data, chunk_end + 4)
+        chunk = data[chunk_start:chunk_end]
+
+        if chunk_type == b'IHDR' and len(chunk) >= 13:
+            header['width'], header['height'], bit_depth, color_type = \
+                struct.unpack('>LLBB', chunk[:10])
+            header['info']['bits'] = bit_depth
+            header['info']['color_type'] = color_type
+            header['info']['interlace'] = chunk[12]
+
+        elif chunk_type == b'pHYs' and len(chunk) >= 9:
+            x_ppu, y_ppu, unit = struct.unpack('>LLB', chunk[:9])
+            if unit == 1:
+                header['info']['dpi'] = (round(x_ppu * 0.0254),
+                                         round(y_ppu * 0.0254))
+
+        elif chunk_type == b'tEXt':
+            key, _, value = chunk.partition(b'\x00')
+            header['info'][key.decode('latin-1')] = value.decode('latin-1')
+
+        elif chunk_type == b'zTXt':
+            key, _, value = chunk.partition(b'\x00')
+            value = _decompress(value[1:])
+            if value is not None:
+                header['info'][key.decode('latin-1')] = value.decode(
+                    'latin-1')
+
+        elif chunk_type == b'iTXt':
+            key, _, rest = chunk.partition(b'\x00')
+            compressed = rest[:1] not in (b'', b'\x00')
+            _, _, rest = rest[2:].partition(b'\x00')
+            _, _, value = rest.partition(b'\x00')
+            if compressed:
+                value = _decompress(value)
+            if value is not None:
+                header['info'][key.decode('latin-1')] = value.decode(
+                    'utf-8', 'replace')
+
+        elif chunk_type == b'iCCP':
+            _, _, value = chunk.partition(b'\x00')
+            value = _decompress(value[1:])
+            if value is not None:
+                header['info']['icc_profile'] = value
+
+        elif chunk_type == b'eXIf':
+            header['exif'], header['gps'] = parse_tiff(chunk)
+
+        pos = chunk_end + 4
+
+
+def _parse_webp(data, header):
+    """
+    Walks WebP chunks, skipping over image data only when an EXIF chunk is
+    known to follow it
+    """
+    pos = 12
+    has_exif = False
+
+    while True:
+        if pos + 8 > len(data):
+            riff_end = 8 + struct.unpack('<L', data[4:8])[0]
+            if pos >= riff_end:
+                break
+            raise HeaderTruncated(pos + 8)
+
+        chunk_type, length = struct.unpack('<4sL', data[pos:pos + 8])
+        chunk_start = pos + 8
+        chunk_end = chunk_start + length
+
+        if chunk_type == b'VP8X':
+            _require(data, chunk_start + 10)
+            flags = data[chunk_start]
+            has_exif = bool(flags & 0x08)
+            header['width'] = 1 + int.from_bytes(
+                data[chunk_start + 4:chunk_start + 7], 'little')
+            header['height'] = 1 + int.from_bytes(
+                data[chunk_start + 7:chunk_start + 10], 'little')
+
+        elif chunk_type == b'VP8 ':
+            _require(data, chunk_start + 10)
+            if header['width'] is None:
+                width, height = struct.unpack(
+                    '<HH', data[chunk_start + 6:chunk_start + 10])
+                header['width'] = width & 0x3FFF
+                header['height'] = height & 0x3FFF
+
+        elif chunk_type == b'VP8L':
+            _require(data, chunk_start + 5)
+            if header['width'] is None:
+                bits, = struct.unpack('<L', data[chunk_start + 1:
+                                                 chunk_start + 5])
+                header['width'] = (bits & 0x3FFF) + 1
+                header['height'] = ((bits >> 14) & 0x3FFF) + 1
+
+        elif chunk_type == b'ICCP':
+            _require(data, chunk_end)
+            header['info']['icc_profile'] = data[chunk_start:chunk_end]
+
+        elif chunk_type == b'EXIF':
+            _require(data, chunk_end)
+            tiff = data[chunk_start:chunk_end]
+            if tiff.startswith(b'Exif\x00\x00'):
+                tiff = tiff[6:]
+            header['exif'], header['gps'] = parse_tiff(tiff)
+            break
+
+        if chunk_type in (b'VP8 ', b'VP8L', b'ANIM') and not has_exif:
+            break
+
+        pos = chunk_end + (length & 1)
+
+
+def _parse_tiff_file(data, header):
+    """
+    Reads a TIFF file's first IFD
+    """
+    header['exif'], header['gps'] = parse_tiff(data)
+    header['width'] = header['exif'].get('ImageWidth')
+    header['height'] = header['exif'].get('ImageLength')
+
+
+def gps_position(gps):
+    """
+    Returns the position held by named GPS values
+
+    :param gps: GPS IFD values by name, rationals as floats
+    :type gps: dict
+    :returns: Dict with decimal ``latitude`` & ``longitude`` and
+        ``altitude`` in metres, holding only those present
+    :rtype: dict
+    """
+    position = {}
+
+    latitude = _gps_degrees(gps.get('GPSLatitude'),
+                            gps.get('GPSLatitudeRef'))
+    longitude = _gps_degrees(gps.get('GPSLongitude'),
+                             gps.get('GPSLongitudeRef'))
+    if latitude is not None and longitude is not None:
+        position['latitude'] = latitude
+        position['longitude'] = longitude
+
+    altitude = gps.get('GPSAltitude')
+    if isinstance(altitude, float):
+        if gps.get('GPSAltitudeRef') in (1, b'\x01'):
+            altitude = -altitude
+        position['altitude'] = altitude
+
+    return position
+
+
+def _decode_gps(header):
+    """
+    Adds decimal degrees & altitude in metres for any GPS position
+    """
+    header.update(gps_position(header['gps']))
+
+
+def parse(data):
+    """
+    Parses metadata from the leading bytes of an image
+
+    :param data: Leading bytes of the image; the whole file is not needed
+    :type data: bytes
+    :returns: Dict with the ``format``, ``width`` & ``height`` of the image,
+        container ``info``, named ``exif`` & ``gps`` values and, when the
+        image is geotagged, decimal ``latitude``, ``longitude`` and
+        ``altitude``
+    :rtype: dict
+    :raises HeaderTruncated: If more leading bytes are needed
+    :raises UnknownFormat: If the image format is not supported
+    """
+    data = bytes(data)
+    header = {
+        'format': None,
+        'width': None,
+        'height': None,
+        'info': {},
+        'exif': {},
+        'gps': {},
+    }
+
+    if data[:2] == b'\xff\xd8':
+        header['format'] = 'JPEG'
+        _parse_jpeg(data, header)
+    elif data[:8] == PNG_SIGNATURE:
+        header['format'] = 'PNG'
+        _parse_png(data, header)
+    elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        header['format'] = 'WEBP'
+        _parse_webp(data, header)
+    elif data[:4] in (b'II*\x00', b'MM\x00*'):
+        header['format'] = 'TIFF'
+        _parse_tiff_file(data, header)
+    elif len(data) < 12:
+        raise HeaderTruncated(12)
+    else:
+        raise UnknownFormat("Unsupported image format")
+
+    _decode_gps(header)
+
+    return header
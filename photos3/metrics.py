@@ -0,0 +1,47 @@
+"""
+photos3.metrics
+===============
+Contains code for reporting metrics
+
+Metrics are printed in the CloudWatch embedded metric format. Lambda ships
+every printed line to CloudWatch Logs, which extracts them into metrics
+without any additional API calls.
+"""
+import json
+import time
+
+
+NAMESPACE = 'PhotoS3'
+
+
+def emit(values, dimensions=None, units=None):
+    """
+    Reports a set of metrics
+
+    :param values: Metric names & values
+    :type values: dict
+    :param dimensions: Dimension names & values shared by every metric
+    :type dimensions: dict
+    :param units: Units of any metric that is not a plain count
+    :type units: dict
+    """
+    dimensions = dimensions or {}
+    units = units or {}
+
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [sorted(dimensions)],
+                'Metrics': [
+                    {'Name': name, 'Unit': units.get(name, 'Count')}
+                    for name in sorted(values)
+                ],
+            }],
+        },
+    }
+    document.update(dimensions)
+    document.update(values)
+
+    print(json.dumps(document))
@@ -3,24 +3,1067 @@ photos3.model
 =============
 Contains code for database models
 """
+import collections
+import concurrent.futures
+import datetime
+import heapq
+import json
 import os
+import random
+import threading
+import time
+
+from pynamodb.constants import STRING
+from pynamodb.exceptions import TransactWriteError
+from pynamodb.exceptions import UpdateError
 from pynamodb.models import Model
+from pynamodb.attributes import BinaryAttribute
+from pynamodb.attributes import NumberAttribute
 from pynamodb.attributes import UnicodeAttribute
-from pynamodb.attributes import JSONAttribute
+from pynamodb.attributes import UnicodeSetAttribute
+from pynamodb.attributes import UTCDateTimeAttribute
+from pynamodb.transactions import TransactWrite
+
+from photos3 import clients
+from photos3 import compact
+from photos3 import geohash
+
+
+# Items held by each model's read-through cache, and the seconds an item (or
+# the knowledge that there is none) is trusted for
+CACHE_SIZE = int(os.environ.get('MODEL_CACHE_SIZE', 4096))
+CACHE_TTL = float(os.environ.get('MODEL_CACHE_TTL', 300))
+CACHE_NEGATIVE_TTL = float(os.environ.get('MODEL_CACHE_NEGATIVE_TTL', 30))
+
+# Length of the geohash cells ImageLocation is partitioned by; 4 characters
+# make cells of about 39 by 20 km
+LOCATION_CELL_PRECISION = int(os.environ.get('LOCATION_CELL_PRECISION', 4))
+
+# Most ImageLocation partitions a single query may read, each costing at
+# least one Query request. At the default precision, 64 is enough for radii
+# of about 50 km, whereas 500 km would take over 1,400.
+LOCATION_MAX_PARTITIONS = int(os.environ.get('LOCATION_MAX_PARTITIONS', 64))
+
+# Shard counts of albums without a marker item saying otherwise, as JSON
+# mapping album names to counts. Albums in neither keep a single partition.
+ALBUM_SHARDS = json.loads(os.environ.get('ALBUM_SHARDS', '{}'))
+
+# Shards of an album queried at once
+ALBUM_QUERY_WORKERS = int(os.environ.get('ALBUM_QUERY_WORKERS', 16))
+
+
+_query_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=ALBUM_QUERY_WORKERS)
+
+
+class ConnectionMeta(object):
+    """
+    Connection settings shared by every model, matching photos3.clients
+    """
+    max_pool_connections = clients.MAX_POOL_CONNECTIONS
+    connect_timeout_seconds = clients.CONNECT_TIMEOUT
+    read_timeout_seconds = clients.READ_TIMEOUT
+    max_retry_attempts = clients.MAX_RETRIES
+
+
+class CompactAttribute(BinaryAttribute):
+    """
+    A metadata document stored compactly as binary, see photos3.compact
+
+    Items written before documents were stored this way hold JSON text,
+    which is still read.
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('legacy_encoding', False)
+        super(CompactAttribute, self).__init__(*args, **kwargs)
+
+    def serialize(self, value):
+        return super(CompactAttribute, self).serialize(compact.encode(value))
+
+    def get_value(self, value):
+        if STRING in value:
+            return value[STRING]
+        return super(CompactAttribute, self).get_value(value)
+
+    def deserialize(self, value):
+        if isinstance(value, str):
+            return json.loads(value, strict=False)
+        return compact.decode(
+            super(CompactAttribute, self).deserialize(value))
 
 
 class ImageMetaData(Model):
-    class Meta:
+    class Meta(ConnectionMeta):
         table_name = os.environ.get('META_TABLE')
 
     checksum = UnicodeAttribute(hash_key=True)
-    exif = JSONAttribute()
-    info = JSONAttribute()
+    exif = CompactAttribute()
+    info = CompactAttribute()
 
 
 class AlbumImage(Model):
-    class Meta:
+    class Meta(ConnectionMeta):
         table_name = os.environ.get('ALBUM_TABLE')
 
     name = UnicodeAttribute(hash_key=True)
     checksum = UnicodeAttribute(range_key=True)
+    # Only set on an album's shard marker
+    shards = NumberAttribute(null=True)
+
+    # Range key of the item recording how many shards an album has, kept in
+    # the partition named after the album
+    SHARD_MARKER = '#shards'
+
+    @classmethod
+    def shard_count(cls, name):
+        """
+        Returns the number of partitions an album's images are spread over
+
+        Large albums are spread over ``<name>#NN`` partitions, picked by
+        checksum, so writes to them aren't throttled as one hot partition.
+        The count comes from the album's marker item, failing that from
+        ``ALBUM_SHARDS``, and is otherwise 1 for the original layout of a
+        single ``<name>`` partition.
+
+        :param name: Album name
+        :type name: str
+        :rtype: int
+        """
+        try:
+            return int(album_cache.get(name, cls.SHARD_MARKER).shards)
+        except cls.DoesNotExist:
+            return int(ALBUM_SHARDS.get(name, 1))
+
+    @classmethod
+    def set_shard_count(cls, name, shards):
+        """
+        Records the number of partitions an album's images are spread over
+
+        Images already in the album stay in the partitions they were
+        written to, so the count should be set before any are added. Warm
+        containers notice it within ``MODEL_CACHE_NEGATIVE_TTL`` seconds.
+
+        :param name: Album name
+        :type name: str
+        :param shards: Number of partitions
+        :type shards: int
+        """
+        marker = cls(name, cls.SHARD_MARKER, shards=shards)
+        marker.save()
+        album_cache.put(marker)
+
+    @classmethod
+    def partition(cls, name, checksum, shards=None):
+        """
+        Returns the partition an image of an album belongs in
+
+        :param name: Album name
+        :type name: str
+        :param checksum: Checksum of the image
+        :type checksum: str
+        :param shards: Number of partitions, looked up when not given
+        :type shards: int
+        :rtype: str
+        """
+        if shards is None:
+            shards = cls.shard_count(name)
+        if shards <= 1:
+            return name
+        return "{n}#{s:02d}".format(n=name, s=int(checksum[:8], 16) % shards)
+
+    @classmethod
+    def link(cls, name, checksum):
+        """
+        Returns the entry adding an image to an album
+
+        :param name: Album name
+        :type name: str
+        :param checksum: Checksum of the image
+        :type checksum: str
+        :rtype: AlbumImage
+        """
+        return cls(cls.partition(name, checksum), checksum)
+
+    @classmethod
+    def partitions(cls, name):
+        """
+        Returns every partition an album's images may be in
+
+        :param name: Album name
+        :type name: str
+        :rtype: list
+        """
+        shards = cls.shard_count(name)
+        if shards <= 1:
+            return [name]
+        return ["{n}#{s:02d}".format(n=name, s=shard)
+                for shard in range(shards)]
+
+    @classmethod
+    def images(cls, name):
+        """
+        Iterates over the images of an album in checksum order
+
+        The partitions of a sharded album are queried concurrently and their
+        results merged.
+
+        :param name: Album name
+        :type name: str
+        :returns: Entries of the album's images
+        """
+        results = _query_pool.map(lambda p: list(cls.query(p)),
+                                  cls.partitions(name))
+        for entry in heapq.merge(*results, key=lambda e: e.checksum):
+            if entry.checksum != cls.SHARD_MARKER:
+                yield entry
+
+
+def _condition_failed(error):
+    """
+    Returns whether a write failed on its condition rather than erroring
+    """
+    if isinstance(error, TransactWriteError):
+        return _cancelled_for(error, 'ConditionalCheckFailed')
+    return error.cause_response_code == 'ConditionalCheckFailedException'
+
+
+def _cancelled_for(error, code):
+    """
+    Returns whether a transaction was cancelled for a reason
+    """
+    return any(reason is not None and reason.code == code
+               for reason in error.cancellation_reasons or [])
+
+
+class AlbumSummary(Model):
+    """
+    Running totals of an album, so album listings read one item per album
+    whatever its size
+
+    Kept up to date by :meth:`add_image` & :meth:`remove_image`, which
+    change an album's membership and its totals in one transaction, so
+    retrying either never counts an image twice or not at all. Transactions
+    on the same totals that conflict are retried with jittered backoff.
+    Sharded albums keep totals per shard, under the shard's partition name,
+    so fewer transactions contend for each item; :meth:`album` combines
+    them. The capture date range only ever widens, so it may outlast the
+    images that set it.
+    """
+    class Meta(ConnectionMeta):
+        table_name = os.environ.get('ALBUM_SUMMARY_TABLE')
+
+    name = UnicodeAttribute(hash_key=True)
+    image_count = NumberAttribute(default=0)
+    total_size = NumberAttribute(default=0)
+    first_captured = UnicodeAttribute(null=True)
+    last_captured = UnicodeAttribute(null=True)
+    # Checksum of the image standing for the album
+    cover = UnicodeAttribute(null=True)
+    updated = UTCDateTimeAttribute(null=True)
+
+    # Attempts at each transaction or update, on top of pynamodb's own
+    # retries, and the most seconds to wait before the first retry, doubling
+    # with every further one
+    UPDATE_ATTEMPTS = 8
+    UPDATE_DELAY = 0.05
+
+    @classmethod
+    def album(cls, name):
+        """
+        Returns the totals of an album, combining those of its shards
+
+        :param name: Album name
+        :type name: str
+        :rtype: AlbumSummary
+        """
+        partitions = AlbumImage.partitions(name)
+        if partitions == [name]:
+            try:
+                return cls.get(name)
+            except cls.DoesNotExist:
+                return cls(name)
+
+        album = cls(name)
+        for shard in sorted(cls.batch_get(partitions),
+                            key=lambda s: s.name):
+            album.image_count += shard.image_count or 0
+            album.total_size += shard.total_size or 0
+            album.cover = album.cover or shard.cover
+            album.first_captured = min(
+                filter(None, [album.first_captured, shard.first_captured]),
+                default=None)
+            album.last_captured = max(
+                filter(None, [album.last_captured, shard.last_captured]),
+                default=None)
+            album.updated = max(
+                filter(None, [album.updated, shard.updated]), default=None)
+        return album
+
+    @classmethod
+    def add_image(cls, name, checksum, size=0, captured=None):
+        """
+        Adds an image to an album, counting it in the album's totals unless
+        it was already in the album
+
+        :param name: Album name
+        :type name: str
+        :param checksum: Checksum of the image
+        :type checksum: str
+        :param size: Size of the image in bytes
+        :type size: int
+        :param captured: Capture time as ``YYYY-MM-DDTHH:MM:SS``
+        :type captured: str
+        :returns: Whether the image was new to the album
+        :rtype: bool
+        """
+        link = AlbumImage.link(name, checksum)
+        summary = cls(link.name)
+
+        def write(transaction):
+            transaction.save(link,
+                             condition=AlbumImage.checksum.does_not_exist())
+            transaction.update(summary, actions=[
+                cls.image_count.add(1),
+                cls.total_size.add(size or 0),
+                cls.cover.set(cls.cover | checksum),
+                cls.updated.set(datetime.datetime.utcnow()),
+            ])
+
+        added = cls._transact(write)
+        album_cache.put(link)
+
+        # Widen the date range, which takes a condition of its own, even
+        # for an image already in the album: a retry after a failure here
+        # finds the link in place
+        if captured:
+            summary._apply([cls.first_captured.set(captured)],
+                           cls.first_captured.does_not_exist() |
+                           (cls.first_captured > captured))
+            summary._apply([cls.last_captured.set(captured)],
+                           cls.last_captured.does_not_exist() |
+                           (cls.last_captured < captured))
+
+        return added
+
+    @classmethod
+    def _transact(cls, write):
+        """
+        Runs a transaction, retrying it with jittered exponential backoff
+        while it conflicts with others
+
+        :param write: Callable adding the writes to a transaction
+        :returns: Whether the transaction was made, rather than one of its
+            conditions failing
+        :rtype: bool
+        """
+        for attempt in range(cls.UPDATE_ATTEMPTS):
+            try:
+                with TransactWrite(
+                        connection=cls._get_connection().connection) as t:
+                    write(t)
+                return True
+
+            except TransactWriteError as e:
+                if _condition_failed(e):
+                    return False
+                if attempt + 1 == cls.UPDATE_ATTEMPTS or not (
+                        _cancelled_for(e, 'TransactionConflict') or
+                        _cancelled_for(e, 'ThrottlingError')):
+                    raise
+                time.sleep(random.uniform(0, cls.UPDATE_DELAY * 2 ** attempt))
+
+    def _apply(self, actions, condition=None):
+        """
+        Updates the item, retrying with exponential backoff
+
+        :returns: Whether the update was made, rather than its condition
+            failing
+        :rtype: bool
+        """
+        for attempt in range(self.UPDATE_ATTEMPTS):
+            try:
+                self.update(actions=actions, condition=condition)
+                return True
+
+            except UpdateError as e:
+                if _condition_failed(e):
+                    return False
+                if attempt + 1 == self.UPDATE_ATTEMPTS:
+                    raise
+                time.sleep(self.UPDATE_DELAY * 2 ** attempt)
+
+    @classmethod
+    def remove_image(cls, name, checksum, size=0):
+        """
+        Removes an image from an album, taking it out of the album's totals
+        if it was in the album
+
+        :param name: Album name
+        :type name: str
+        :param checksum: Checksum of the image
+        :type checksum: str
+        :param size: Size of the image in bytes
+        :type size: int
+        :returns: Whether the image was in the album
+        :rtype: bool
+        """
+        link = AlbumImage.link(name, checksum)
+        summary = cls(link.name)
+
+        def write(transaction):
+            transaction.delete(link, condition=AlbumImage.checksum.exists())
+            transaction.update(summary, actions=[
+                cls.image_count.add(-1),
+                cls.total_size.add(-(size or 0)),
+                cls.updated.set(datetime.datetime.utcnow()),
+            ])
+
+        try:
+            removed = cls._transact(write)
+        finally:
+            album_cache.invalidate(link.name, checksum)
+
+        # The album needs a new cover if this was it, even when a retry
+        # finds the image already gone
+        summary._apply([cls.cover.remove()], cls.cover == checksum)
+
+        return removed
+
+
+class ImageSummary(Model):
+    """
+    The few attributes of an image listing views need, kept apart from its
+    full metadata so reading them costs a fraction of the capacity
+    """
+    class Meta(ConnectionMeta):
+        table_name = os.environ.get('SUMMARY_TABLE')
+
+    checksum = UnicodeAttribute(hash_key=True)
+    key = UnicodeAttribute(null=True)
+    width = NumberAttribute(null=True)
+    height = NumberAttribute(null=True)
+    orientation = NumberAttribute(null=True)
+    captured = UnicodeAttribute(null=True)
+    size = NumberAttribute(null=True)
+    mime_type = UnicodeAttribute(null=True)
+    # Thumbnail sizes rendered so far, as "<width>x<height>"
+    renditions = UnicodeSetAttribute(null=True)
+
+    # Attributes read by listing views
+    LISTING_ATTRIBUTES = [
+        'checksum',
+        'key',
+        'width',
+        'height',
+        'orientation',
+        'captured',
+        'renditions',
+    ]
+
+    @classmethod
+    def listing(cls, checksums, attributes=None):
+        """
+        Reads the summaries of several images, projected down to the
+        attributes a listing needs
+
+        :param checksums: Checksums of the images
+        :type checksums: list
+        :param attributes: Attributes to read, ``LISTING_ATTRIBUTES`` by
+            default
+        :type attributes: list
+        :returns: Summaries found, in no particular order
+        :rtype: list
+        """
+        return list(cls.batch_get(
+            checksums,
+            attributes_to_get=attributes or cls.LISTING_ATTRIBUTES))
+
+    @classmethod
+    def add_renditions(cls, checksum, sizes):
+        """
+        Records that thumbnails of an image have been rendered
+
+        :param checksum: Checksum of the image
+        :type checksum: str
+        :param sizes: Maximum width & height of each thumbnail
+        :type sizes: list
+        """
+        cls(checksum).update(actions=[
+            cls.renditions.add({"{}x{}".format(w, h) for w, h in sizes}),
+        ])
+
+
+def _timestamp(value):
+    """
+    Returns a date or time as ISO 8601 text, leaving text as it is
+    """
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def _months(first, last):
+    """
+    Returns every ``YYYY-MM`` month from one to another, inclusive
+    """
+    year, month = int(first[:4]), int(first[5:7])
+    months = []
+    while "{:04d}-{:02d}".format(year, month) <= last:
+        months.append("{:04d}-{:02d}".format(year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+class ImageTimeline(Model):
+    """
+    Index of images by capture time
+
+    Images are partitioned by the month they were captured in and sorted
+    within it by ``<capture time>#<checksum>``, capture times being ISO 8601
+    text, so a range of dates is read with one query per month rather than
+    a scan.
+    """
+    class Meta(ConnectionMeta):
+        table_name = os.environ.get('TIMELINE_TABLE')
+
+    month = UnicodeAttribute(hash_key=True)
+    sort_key = UnicodeAttribute(range_key=True)
+
+    @classmethod
+    def entry(cls, captured, checksum):
+        """
+        Returns the index entry of an image
+
+        :param captured: Capture time as ``YYYY-MM-DDTHH:MM:SS``
+        :type captured: str
+        :param checksum: Checksum of the image
+        :type checksum: str
+        :rtype: ImageTimeline
+        """
+        return cls(captured[:7], "{t}#{c}".format(t=captured, c=checksum))
+
+    @property
+    def captured(self):
+        return self.sort_key.split('#', 1)[0]
+
+    @property
+    def checksum(self):
+        return self.sort_key.split('#', 1)[1]
+
+    @classmethod
+    def page(cls, start, end, limit=100, cursor=None, newest_first=False):
+        """
+        Reads one page of the images captured within a range of time
+
+        :param start: Earliest capture time, as a date, time or a prefix of
+            ``YYYY-MM-DDTHH:MM:SS``
+        :param end: Latest capture time, likewise. Prefixes include
+            everything they cover, e.g. ``2016-03`` the whole month.
+        :param limit: Most entries to return
+        :type limit: int
+        :param cursor: Cursor returned with the previous page
+        :type cursor: dict
+        :param newest_first: Whether to read the range backwards
+        :type newest_first: bool
+        :returns: Entries of the page in order & the cursor of the next
+            page, which is None after the last
+        :rtype: tuple
+        """
+        start = _timestamp(start)
+        end = _timestamp(end) + u'\uffff'
+
+        months = _months((start + '-01')[:7], end[:7])
+        if newest_first:
+            months.reverse()
+
+        last_key = None
+        if cursor is not None:
+            months = months[months.index(cursor['month']):]
+            last_key = cursor['last_key']
+
+        entries = []
+        for n, month in enumerate(months):
+            results = cls.query(
+                month,
+                cls.sort_key.between(start, end),
+                scan_index_forward=not newest_first,
+                limit=limit - len(entries),
+                last_evaluated_key=last_key)
+            entries.extend(results)
+
+            last_key = results.last_evaluated_key
+            if last_key is not None:
+                return entries, {'month': month, 'last_key': last_key}
+
+            if len(entries) >= limit:
+                if n + 1 < len(months):
+                    return entries, {'month': months[n + 1], 'last_key': None}
+                break
+
+        return entries, None
+
+    @classmethod
+    def between(cls, start, end, page_size=100, newest_first=False):
+        """
+        Iterates over every image captured within a range of time, reading
+        a page at a time
+
+        Takes the same arguments as :meth:`page`.
+        """
+        cursor = None
+        while True:
+            entries, cursor = cls.page(start, end,
+                                       limit=page_size,
+                                       cursor=cursor,
+                                       newest_first=newest_first)
+            for entry in entries:
+                yield entry
+            if cursor is None:
+                return
+
+
+class ImageLocation(Model):
+    """
+    Index of geotagged images by position
+
+    Images are partitioned by the geohash cell of ``LOCATION_CELL_PRECISION``
+    characters they lie in and sorted within it by ``<geohash>#<checksum>``,
+    so smaller cells are read by geohash prefix. Queries read the cells
+    covering an area and keep only the images that really lie within it.
+
+    Every partition an area overlaps takes at least one Query, so areas
+    overlapping more than ``LOCATION_MAX_PARTITIONS`` are refused rather
+    than read. The cells are queried concurrently.
+    """
+    class Meta(ConnectionMeta):
+        table_name = os.environ.get('LOCATION_TABLE')
+
+    cell = UnicodeAttribute(hash_key=True)
+    sort_key = UnicodeAttribute(range_key=True)
+    latitude = NumberAttribute()
+    longitude = NumberAttribute()
+
+    @classmethod
+    def entry(cls, latitude, longitude, checksum):
+        """
+        Returns the index entry of an image
+
+        :param latitude: Latitude in decimal degrees
+        :type latitude: float
+        :param longitude: Longitude in decimal degrees
+        :type longitude: float
+        :param checksum: Checksum of the image
+        :type checksum: str
+        :rtype: ImageLocation
+        """
+        position = geohash.encode(latitude, longitude)
+        return cls(position[:LOCATION_CELL_PRECISION],
+                   "{g}#{c}".format(g=position, c=checksum),
+                   latitude=latitude,
+                   longitude=longitude)
+
+    @property
+    def checksum(self):
+        return self.sort_key.split('#', 1)[1]
+
+    @classmethod
+    def _candidates(cls, south, west, north, east, max_cells):
+        """
+        Iterates over the entries of every cell covering a bounding box
+
+        :raises ValueError: If the box overlaps more than
+            ``LOCATION_MAX_PARTITIONS`` partitions
+        """
+        partitions = geohash.cell_count(south, west, north, east,
+                                        LOCATION_CELL_PRECISION)
+        if partitions > LOCATION_MAX_PARTITIONS:
+            raise ValueError(
+                "Area overlaps {n} location partitions, more than the "
+                "{m} allowed".format(n=partitions, m=LOCATION_MAX_PARTITIONS))
+
+        cells = geohash.covering_cells(
+            south, west, north, east,
+            min_precision=LOCATION_CELL_PRECISION,
+            max_cells=max_cells)
+
+        def read(cell):
+            partition = cell[:LOCATION_CELL_PRECISION]
+            if len(cell) == LOCATION_CELL_PRECISION:
+                return list(cls.query(partition))
+            return list(cls.query(partition, cls.sort_key.startswith(cell)))
+
+        for results in _query_pool.map(read, cells):
+            for entry in results:
+                yield entry
+
+    @classmethod
+    def within_bounds(cls, south, west, north, east, max_cells=16):
+        """
+        Returns the images lying within a bounding box
+
+        :param south: Southern edge in decimal degrees
+        :param west: Western edge in decimal degrees; greater than ``east``
+            when the box crosses the antimeridian
+        :param north: Northern edge in decimal degrees
+        :param east: Eastern edge in decimal degrees
+        :param max_cells: Most geohash cells to read, unless the box needs
+            more than that many partitions
+        :type max_cells: int
+        :rtype: list
+        :raises ValueError: If the box overlaps more than
+            ``LOCATION_MAX_PARTITIONS`` partitions
+        """
+        return [
+            entry
+            for entry in cls._candidates(south, west, north, east, max_cells)
+            if geohash.in_bounds(entry.latitude, entry.longitude,
+                                 south, west, north, east)
+        ]
+
+    @classmethod
+    def within_radius(cls, latitude, longitude, radius, max_cells=16):
+        """
+        Returns the images lying within a distance of a position, nearest
+        first
+
+        :param latitude: Latitude of the position in decimal degrees
+        :type latitude: float
+        :param longitude: Longitude of the position in decimal degrees
+        :type longitude: float
+        :param radius: Distance in metres
+        :type radius: float
+        :param max_cells: Most geohash cells to read, unless the area needs
+            more than that many partitions
+        :type max_cells: int
+        :returns: Tuples of distance in metres & entry
+        :rtype: list
+        :raises ValueError: If the area overlaps more than
+            ``LOCATION_MAX_PARTITIONS`` partitions
+        """
+        south, west, north, east = geohash.radius_bounds(latitude,
+                                                         longitude,
+                                                         radius)
+
+        found = []
+        for entry in cls._candidates(south, west, north, east, max_cells):
+            metres = geohash.distance(latitude, longitude,
+                                      entry.latitude, entry.longitude)
+            if metres <= radius:
+                found.append((metres, entry))
+
+        found.sort(key=lambda match: match[0])
+        return found
+
+
+class WriteBatch(object):
+    """
+    Collects model writes to be flushed together with ``batch_write()``
+
+    Actions depending on the writes, such as removing the source of the
+    data, can be registered to run only once every write has succeeded.
+    Items sharing a primary key are written once, the last one queued
+    winning, as a batch may not hold the same key twice. Items whose
+    existence is taken to mean the others were written, such as an image's
+    ImageMetaData, are queued with ``last`` so they are only written once
+    everything else has been. Work sharing the batch can :meth:`claim` keys
+    so that only one piece of it handles each. Safe to use from several
+    threads at once.
+    """
+    def __init__(self, max_attempts=5, base_delay=0.1):
+        """
+        :param max_attempts: Attempts at writing each model's items before
+            giving up, on top of pynamodb's own retries of unprocessed items
+        :type max_attempts: int
+        :param base_delay: Seconds to wait before the first retry, doubling
+            with every further one
+        :type base_delay: float
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+
+        self._items = collections.OrderedDict()
+        self._last_items = collections.OrderedDict()
+        self._actions = []
+        self._claims = set()
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """
+        Claims a key, such as an image's checksum, until the next flush
+
+        :param key: Key to claim
+        :returns: Whether the key was unclaimed
+        :rtype: bool
+        """
+        with self._lock:
+            if key in self._claims:
+                return False
+            self._claims.add(key)
+            return True
+
+    def save(self, item, last=False):
+        """
+        Queues a model item to be written
+
+        :param item: Model item
+        :type item: pynamodb.models.Model
+        :param last: Write the item only once every item queued without
+            ``last`` has been written
+        :type last: bool
+        """
+        model = type(item)
+        key = getattr(item, model._hash_keyname)
+        if model._range_keyname is not None:
+            key = (key, getattr(item, model._range_keyname))
+
+        with self._lock:
+            queue = self._last_items if last else self._items
+            items = queue.setdefault(model, collections.OrderedDict())
+            items.pop(key, None)
+            items[key] = item
+
+    def after_flush(self, action):
+        """
+        Registers an action to run once every queued write has succeeded
+
+        :param action: Callable taking no arguments
+        """
+        with self._lock:
+            self._actions.append(action)
+
+    def _write(self, model, items):
+        """
+        Writes one model's items, retrying with exponential backoff
+
+        Requests DynamoDB rejects as invalid would fail the same way again,
+        so are not retried.
+        """
+        for attempt in range(self.max_attempts):
+            try:
+                with model.batch_write() as batch:
+                    for item in items:
+                        batch.save(item)
+                return
+
+            except Exception as e:
+                if (attempt + 1 == self.max_attempts or
+                        getattr(e, 'cause_response_code', None) ==
+                        'ValidationException'):
+                    raise
+                time.sleep(self.base_delay * 2 ** attempt)
+
+    def flush(self):
+        """
+        Writes every queued item and then runs the registered actions
+
+        :raises Exception: The first write or action that failed
+        """
+        with self._lock:
+            queues = [self._items, self._last_items]
+            actions = self._actions
+            self._items = collections.OrderedDict()
+            self._last_items = collections.OrderedDict()
+            self._actions = []
+            self._claims = set()
+
+        for items in queues:
+            for model, model_items in items.items():
+                print("Writing {n} {m} items".format(
+                    n=len(model_items),
+                    m=model.__name__))
+                self._write(model, list(model_items.values()))
+
+        for action in actions:
+            action()
+
+
+class ModelCache(object):
+    """
+    Read-through cache of a model's items, keyed by their primary key
+
+    Items are kept in least recently used order, evicted once there are more
+    than ``size`` of them, and trusted for ``ttl`` seconds. Keys without an
+    item are remembered for ``negative_ttl`` seconds. Concurrent reads of the
+    same key share a single request, as do the misses of a ``batch_get()``.
+
+    Held at module level so the cache survives between invocations of a warm
+    container; writers call ``put()`` or ``invalidate()`` to keep it current.
+    """
+    def __init__(self, model, size=CACHE_SIZE, ttl=CACHE_TTL,
+                 negative_ttl=CACHE_NEGATIVE_TTL):
+        """
+        :param model: Model whose items are cached
+        :type model: type
+        :param size: Most keys to hold
+        :type size: int
+        :param ttl: Seconds an item is trusted for
+        :type ttl: float
+        :param negative_ttl: Seconds the absence of an item is trusted for
+        :type negative_ttl: float
+        """
+        self.model = model
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        # key: (expiry, item or None)
+        self._entries = collections.OrderedDict()
+        # key: event set once the key's read completes
+        self._reading = {}
+        self._lock = threading.Lock()
+
+    def _key(self, item):
+        """
+        Returns the cache key of a model item
+        """
+        if self.model._range_keyname is None:
+            return getattr(item, self.model._hash_keyname)
+        return (getattr(item, self.model._hash_keyname),
+                getattr(item, self.model._range_keyname))
+
+    def _lookup(self, key):
+        """
+        Returns whether a key is cached and its item, with the lock held
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+
+        expiry, item = entry
+        if expiry < time.time():
+            del self._entries[key]
+            return False, None
+
+        self._entries.move_to_end(key)
+        return True, item
+
+    def _store(self, key, item):
+        """
+        Caches an item, or its absence, with the lock held
+        """
+        ttl = self.negative_ttl if item is None else self.ttl
+        if ttl <= 0 or self.size <= 0:
+            self._entries.pop(key, None)
+            return
+
+        self._entries[key] = (time.time() + ttl, item)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def _claim(self, keys):
+        """
+        Sorts keys into cached items, keys this thread is to read and keys
+        already being read by another thread
+        """
+        found = {}
+        claimed = []
+        waiting = []
+
+        with self._lock:
+            for key in keys:
+                hit, item = self._lookup(key)
+                if hit:
+                    self.hits += 1
+                    if item is not None:
+                        found[key] = item
+                elif key in self._reading:
+                    waiting.append((key, self._reading[key]))
+                elif key not in claimed:
+                    self.misses += 1
+                    self._reading[key] = threading.Event()
+                    claimed.append(key)
+
+        return found, claimed, waiting
+
+    def _release(self, claimed, items):
+        """
+        Caches the outcome of reading claimed keys and wakes their waiters
+        """
+        with self._lock:
+            for key in claimed:
+                if key in items:
+                    self._store(key, items[key])
+                self._reading.pop(key).set()
+
+    def get(self, hash_key, range_key=None):
+        """
+        Returns an item, reading it from DynamoDB unless cached
+
+        :raises DoesNotExist: If there is no such item
+        :rtype: pynamodb.models.Model
+        """
+        key = hash_key if range_key is None else (hash_key, range_key)
+        item = self.batch_get([key]).get(key)
+        if item is None:
+            raise self.model.DoesNotExist()
+        return item
+
+    def batch_get(self, keys):
+        """
+        Returns the items of several keys, reading every uncached key in
+        one ``batch_get()``
+
+        :param keys: Hash keys, or (hash key, range key) tuples for models
+            with a range key
+        :type keys: list
+        :returns: Items found, by key
+        :rtype: dict
+        """
+        found, claimed, waiting = self._claim(keys)
+
+        if claimed:
+            items = {}
+            try:
+                for item in self.model.batch_get(claimed):
+                    items[self._key(item)] = item
+                for key in claimed:
+                    items.setdefault(key, None)
+            finally:
+                self._release(claimed, items)
+
+            found.update((k, v) for k, v in items.items() if v is not None)
+
+        # Keys read by another thread are looked up again once it is done,
+        # reading them here after all should that read have failed
+        if waiting:
+            for _, event in waiting:
+                event.wait()
+            found.update(self.batch_get([key for key, _ in waiting]))
+
+        return found
+
+    def put(self, item):
+        """
+        Caches an item that was just written
+
+        :param item: Model item
+        :type item: pynamodb.models.Model
+        """
+        with self._lock:
+            self._store(self._key(item), item)
+
+    def invalidate(self, hash_key, range_key=None):
+        """
+        Forgets whatever is cached for a key
+
+        :param hash_key: Item's hash key
+        :param range_key: Item's range key, for models with one
+        """
+        key = hash_key if range_key is None else (hash_key, range_key)
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Forgets every cached item
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+image_cache = ModelCache(ImageMetaData)
+album_cache = ModelCache(AlbumImage)
@@ -0,0 +1,183 @@
+"""
+photos3.scheduling
+==================
+Contains code for deciding how much work an invocation takes on
+"""
+import collections
+import math
+import time
+
+
+class CostEstimator(object):
+    """
+    Estimates how long a unit of work takes from recent history
+
+    Kept at module level by handlers so the history survives between
+    invocations of a warm container.
+    """
+    def __init__(self, history=50, default=10.0, percentile=0.9):
+        """
+        :param history: Number of recent durations to keep
+        :type history: int
+        :param default: Estimate in seconds before anything was recorded
+        :type default: float
+        :param percentile: Percentile of recent durations used as the
+            estimate, erring towards slow outliers
+        :type percentile: float
+        """
+        self.durations = collections.deque(maxlen=history)
+        self.default = default
+        self.percentile = percentile
+
+    def record(self, seconds):
+        """
+        Records how long one unit of work took
+
+        :param seconds: Duration in seconds
+        :type seconds: float
+        """
+        self.durations.append(seconds)
+
+    def timed(self, func, *args, **kwargs):
+        """
+        Calls a function, recording how long it took
+
+        :returns: Whatever the function returned
+        """
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(time.time() - start)
+
+    def estimate(self):
+        """
+        Returns the expected duration of one unit of work in seconds
+
+        :rtype: float
+        """
+        if not self.durations:
+            return self.default
+
+        durations = sorted(self.durations)
+        index = min(int(len(durations) * self.percentile), len(durations) - 1)
+        return durations[index]
+
+
+class TimeBudget(object):
+    """
+    Tracks the time an invocation has left against the cost of its work
+    """
+    def __init__(self, context, estimator, reserve=15.0):
+        """
+        :param context: Lambda context, or None when run outside of Lambda
+        :param estimator: Estimator of the cost of one unit of work
+        :type estimator: CostEstimator
+        :param reserve: Seconds kept back for receiving, publishing and
+            cleaning up around the work itself
+        :type reserve: float
+        """
+        self.context = context
+        self.estimator = estimator
+        self.reserve = reserve
+
+    def remaining(self):
+        """
+        Returns the number of seconds the invocation has left
+
+        :rtype: float
+        """
+        if self.context is None:
+            return float('inf')
+        return self.context.get_remaining_time_in_millis() / 1000.0
+
+    def capacity(self, workers=1):
+        """
+        Returns how many units of work still fit in the invocation
+
+        :param workers: Number of units worked on concurrently
+        :type workers: int
+        :rtype: int
+        """
+        estimate = max(self.estimator.estimate(), 0.001)
+        rounds = (self.remaining() - self.reserve) / estimate
+        if rounds == float('inf'):
+            return rounds
+        return max(int(rounds), 0) * max(workers, 1)
+
+
+def plan_workers(backlog, in_flight=0, per_worker=50, ceiling=10,
+                 worker_batch=10):
+    """
+    Returns how many more drain workers a queue's backlog calls for
+
+    :param backlog: Messages waiting to be received
+    :type backlog: int
+    :param in_flight: Messages received but not yet deleted, each worker
+        holding up to ``worker_batch`` of them at a time
+    :type in_flight: int
+    :param per_worker: Backlog each worker is expected to drain
+    :type per_worker: int
+    :param ceiling: Most workers to have running at once
+    :type ceiling: int
+    :param worker_batch: Most messages a worker holds at once
+    :type worker_batch: int
+    :rtype: int
+    """
+    if backlog <= 0:
+        return 0
+
+    wanted = min(int(math.ceil(float(backlog) / per_worker)), ceiling)
+    running = int(math.ceil(float(in_flight) / worker_batch))
+    return max(wanted - running, 0)
+
+
+class DrainController(object):
+    """
+    Starts queue drain workers in proportion to the queue's backlog
+
+    Works with anything offering a boto3 SQS queue's ``load()`` and
+    ``attributes``, so it can be driven offline by an in-memory queue.
+    """
+    def __init__(self, queue, start_worker, per_worker=50, ceiling=10):
+        """
+        :param queue: SQS queue
+        :type queue: boto3.resources.factory.sqs.Queue
+        :param start_worker: Callable starting one drain worker
+        :param per_worker: Backlog each worker is expected to drain
+        :type per_worker: int
+        :param ceiling: Most workers to have running at once
+        :type ceiling: int
+        """
+        self.queue = queue
+        self.start_worker = start_worker
+        self.per_worker = per_worker
+        self.ceiling = ceiling
+
+    def run(self):
+        """
+        Starts as many workers as the current backlog calls for
+
+        :returns: Number of workers started
+        :rtype: int
+        """
+        self.queue.load()
+        attributes = self.queue.attributes
+        backlog = int(attributes.get('ApproximateNumberOfMessages', 0))
+        in_flight = int(attributes.get(
+            'ApproximateNumberOfMessagesNotVisible', 0))
+
+        workers = plan_workers(backlog,
+                               in_flight=in_flight,
+                               per_worker=self.per_worker,
+                               ceiling=self.ceiling)
+
+        print("Backlog of {b} ({f} in flight), starting {w} workers".format(
+            b=backlog,
+            f=in_flight,
+            w=workers))
+
+        for _ in range(workers):
+            self.start_worker()
+
+        return workers
@@ -50,6 +50,7 @@ setup(
             'terminaltables',
         ],
         'test': [
+            'pytest',
         ],
     },
 
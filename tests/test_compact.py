@@ -0,0 +1,68 @@
+"""
+Tests for photos3.compact
+"""
+import os
+
+import pytest
+
+from photos3 import compact
+from photos3.model import CompactAttribute
+
+
+DOCUMENT = {
+    'Make': 'Canon',
+    'FNumber': 2.8,
+    'Flash': False,
+    'Software': None,
+    'MakerNote': b'\x00\x01\xff' * 10,
+    'GPSInfo': {1: 'N', 2: (45.0, 30.0, 36.0)},
+    'Thumbnails': [b'\xff\xd8', b'', b'\xff\xd9'],
+    '$b': [0, 2],
+    '$$dollars': 'kept',
+}
+
+EXPECTED = dict(DOCUMENT,
+                GPSInfo={'1': 'N', '2': [45.0, 30.0, 36.0]})
+
+
+@pytest.mark.parametrize('value, expected', [
+    (DOCUMENT, EXPECTED),
+    ({'nested': {'deeper': {'blob': b'raw'}}},
+     {'nested': {'deeper': {'blob': b'raw'}}}),
+    ([b'one', (b'two', u'dr\xe9i')], [b'one', [b'two', u'dr\xe9i']]),
+    (b'', b''),
+    ({}, {}),
+    (None, None),
+])
+def test_round_trip(value, expected):
+    assert compact.decode(compact.encode(value)) == expected
+
+
+def test_raw_and_compressed():
+    small = compact.encode({'a': os.urandom(16)})
+    assert small[:1] == compact.RAW
+
+    large = compact.encode({'a': b'\x00' * 4096})
+    assert large[:1] == compact.ZLIB
+    assert len(large) < 4096
+    assert compact.decode(large) == {'a': b'\x00' * 4096}
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        compact.decode(b'\x02' + compact.encode({})[1:])
+
+
+def test_attribute_round_trip():
+    attribute = CompactAttribute()
+    serialized = attribute.serialize(DOCUMENT)
+    assert attribute.deserialize(
+        attribute.get_value({'B': serialized})) == EXPECTED
+
+
+def test_attribute_reads_legacy_json():
+    attribute = CompactAttribute()
+    # Older items may hold unescaped control characters
+    legacy = '{"Make": "Canon", "Note": "line\nbreak"}'
+    assert attribute.deserialize(attribute.get_value({'S': legacy})) == {
+        'Make': 'Canon', 'Note': 'line\nbreak'}
@@ -0,0 +1,118 @@
+"""
+Tests for photos3.geohash
+"""
+import itertools
+
+import pytest
+
+from photos3 import geohash
+
+
+def _covers(hashes, latitude, longitude):
+    return any(
+        geohash.in_bounds(latitude, longitude, *geohash.bounds(h))
+        for h in hashes)
+
+
+def test_encode():
+    assert geohash.encode(57.64911, 10.40744, 11) == 'u4pruydqqvj'
+    assert geohash.encode(-90.0, -180.0, 4) == '0000'
+
+
+@pytest.mark.parametrize('latitude, longitude', [
+    (57.64911, 10.40744),
+    (-33.8688, 151.2093),
+    (0.0, 0.0),
+    (64.1466, -21.9426),
+])
+def test_bounds_contain_position(latitude, longitude):
+    for precision in range(1, 13):
+        south, west, north, east = geohash.bounds(
+            geohash.encode(latitude, longitude, precision))
+        assert south <= latitude <= north
+        assert west <= longitude <= east
+
+
+@pytest.mark.parametrize('box', [
+    (50.0, -1.0, 52.0, 1.0),
+    (-17.5, 178.0, -16.0, -179.0),
+    (60.0, 170.0, 70.0, -170.0),
+])
+def test_cells_cover_box(box):
+    south, west, north, east = box
+    hashes = geohash.cells(south, west, north, east, 3)
+
+    assert len(hashes) == len(set(hashes))
+    assert len(hashes) == geohash.cell_count(south, west, north, east, 3)
+
+    longitudes = [west, east, (west + 0.01), (east - 0.01)]
+    for latitude, longitude in itertools.product(
+            [south, north, (south + north) / 2], longitudes):
+        assert _covers(hashes, latitude, longitude)
+
+
+def test_cells_across_antimeridian():
+    hashes = geohash.cells(-17.5, 178.0, -16.0, -179.0, 3)
+    wests = [geohash.bounds(h)[1] for h in hashes]
+    assert min(wests) < 0 < max(wests)
+    assert not _covers(hashes, -16.5, 0.0)
+
+
+@pytest.mark.parametrize('box', [
+    (50.0, -1.0, 52.0, 1.0),
+    (51.49, -0.13, 51.51, -0.11),
+    (-17.5, 178.0, -16.0, -179.0),
+])
+@pytest.mark.parametrize('max_cells', [2, 4, 16, 64])
+def test_covering_cells(box, max_cells):
+    hashes = geohash.covering_cells(*box, max_cells=max_cells)
+    assert len(hashes) <= max_cells
+    assert _covers(hashes, (box[0] + box[2]) / 2, box[1])
+
+
+def test_covering_cells_min_precision():
+    # Held to a precision, a large box takes more than max_cells
+    box = (40.0, -10.0, 60.0, 30.0)
+    hashes = geohash.covering_cells(*box, min_precision=4, max_cells=16)
+    assert len(hashes) == geohash.cell_count(*box, precision=4) > 16
+    assert all(len(h) == 4 for h in hashes)
+
+
+def test_in_bounds():
+    assert geohash.in_bounds(10.0, 20.0, 0.0, 10.0, 20.0, 30.0)
+    assert not geohash.in_bounds(10.0, 40.0, 0.0, 10.0, 20.0, 30.0)
+    assert not geohash.in_bounds(30.0, 20.0, 0.0, 10.0, 20.0, 30.0)
+
+    # Across the antimeridian
+    assert geohash.in_bounds(0.0, 179.5, -1.0, 179.0, 1.0, -179.0)
+    assert geohash.in_bounds(0.0, -179.5, -1.0, 179.0, 1.0, -179.0)
+    assert not geohash.in_bounds(0.0, 0.0, -1.0, 179.0, 1.0, -179.0)
+
+
+def test_radius_bounds():
+    south, west, north, east = geohash.radius_bounds(51.5, -0.1, 10000)
+    assert south < 51.5 < north
+    assert west < -0.1 < east
+    assert geohash.distance(51.5, -0.1, north, -0.1) == pytest.approx(
+        10000)
+    # The box encloses the circle
+    assert geohash.distance(51.5, -0.1, 51.5, east) >= 10000
+
+
+def test_radius_bounds_across_antimeridian():
+    south, west, north, east = geohash.radius_bounds(0.0, 179.99, 10000)
+    assert west > east
+    assert geohash.in_bounds(0.0, -179.99, south, west, north, east)
+
+
+def test_radius_bounds_near_pole():
+    assert geohash.radius_bounds(89.9, 45.0, 50000)[1::2] == (-180.0,
+                                                             180.0)
+
+
+def test_distance():
+    assert geohash.distance(0.0, 0.0, 1.0, 0.0) == pytest.approx(
+        111195, abs=1)
+    assert geohash.distance(0.0, 179.5, 0.0, -179.5) == pytest.approx(
+        geohash.distance(0.0, 0.0, 0.0, 1.0))
+    assert geohash.distance(10.0, 10.0, 10.0, 10.0) == 0
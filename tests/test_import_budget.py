@@ -0,0 +1,22 @@
+"""
+Tests for util/import_budget.py
+"""
+import importlib.util
+import os
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _import_budget():
+    spec = importlib.util.spec_from_file_location(
+        'import_budget', os.path.join(ROOT, 'util', 'import_budget.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_handlers_within_budget(monkeypatch):
+    # The measurements import photos3 from the working directory
+    monkeypatch.chdir(ROOT)
+    assert _import_budget().main([]) == 0
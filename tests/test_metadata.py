@@ -0,0 +1,134 @@
+"""
+Tests for photos3.metadata
+"""
+import io
+import struct
+import zlib
+
+import pytest
+from PIL import Image
+from PIL import PngImagePlugin
+
+from photos3 import metadata
+
+
+def _exif():
+    exif = Image.Exif()
+    exif[0x010f] = 'Canon'
+    exif.get_ifd(metadata.EXIF_IFD)[0x9003] = '2016:03:05 10:11:12'
+    gps = exif.get_ifd(metadata.GPS_IFD)
+    gps[1] = 'N'
+    gps[2] = (45.0, 30.0, 36.0)
+    gps[3] = 'W'
+    gps[4] = (122.0, 40.0, 0.0)
+    return exif
+
+
+def _image(format, size=(40, 30), **kwargs):
+    buf = io.BytesIO()
+    Image.new('RGB', size, 'red').save(buf, format, **kwargs)
+    return buf.getvalue()
+
+
+def _chunk(chunk_type, data):
+    return (struct.pack('>L', len(data)) + chunk_type + data +
+            struct.pack('>L', zlib.crc32(chunk_type + data)))
+
+
+def _png(*chunks):
+    ihdr = struct.pack('>LLBBBBB', 40, 30, 8, 2, 0, 0, 0)
+    return (metadata.PNG_SIGNATURE + _chunk(b'IHDR', ihdr) +
+            b''.join(chunks) + _chunk(b'IEND', b''))
+
+
+@pytest.mark.parametrize('format', ['JPEG', 'WEBP'])
+def test_exif_and_gps(format):
+    header = metadata.parse(_image(format, exif=_exif()))
+
+    assert header['format'] == format
+    assert (header['width'], header['height']) == (40, 30)
+    assert header['exif']['Make'] == 'Canon'
+    assert header['exif']['DateTimeOriginal'] == '2016:03:05 10:11:12'
+    assert header['latitude'] == pytest.approx(45.51)
+    assert header['longitude'] == pytest.approx(-122.6667, abs=1e-4)
+
+
+def test_tiff_ifd_after_pixels():
+    # A little-endian TIFF laid out as header, pixels, IFD0 & EXIF IFD
+    pixels = b'\x07' * (40 * 30)
+    ifd_offset = 8 + len(pixels)
+    exif_offset = ifd_offset + 2 + 4 * 12 + 4
+    date_offset = exif_offset + 2 + 12 + 4
+    date = b'2016:03:05 10:11:12\x00'
+
+    ifd = struct.pack('<H', 4) + b''.join(
+        struct.pack('<HHLL', *entry) for entry in [
+            (256, 4, 1, 40),
+            (257, 4, 1, 30),
+            (273, 4, 1, 8),
+            (metadata.EXIF_IFD, 4, 1, exif_offset),
+        ]) + struct.pack('<L', 0)
+    exif = (struct.pack('<H', 1) +
+            struct.pack('<HHLL', 0x9003, 2, len(date), date_offset) +
+            struct.pack('<L', 0) + date)
+    data = b'II*\x00' + struct.pack('<L', ifd_offset) + pixels + ifd + exif
+
+    with pytest.raises(metadata.HeaderTruncated) as raised:
+        metadata.parse(data[:1024])
+    assert raised.value.needed > 1024
+
+    header = metadata.parse(data)
+    assert header['format'] == 'TIFF'
+    assert (header['width'], header['height']) == (40, 30)
+    assert header['exif']['DateTimeOriginal'] == '2016:03:05 10:11:12'
+
+
+def test_png_text():
+    info = PngImagePlugin.PngInfo()
+    info.add_text('plain', 'one')
+    info.add_text('zipped', 'two', zip=True)
+    info.add_itxt('international', u'dr\xe9i', zip=True)
+    header = metadata.parse(_image('PNG', pnginfo=info))
+
+    assert (header['width'], header['height']) == (40, 30)
+    assert header['info']['plain'] == 'one'
+    assert header['info']['zipped'] == 'two'
+    assert header['info']['international'] == u'dr\xe9i'
+
+
+def test_png_skips_bad_chunks():
+    bomb = zlib.compress(b'\x00' * (metadata.MAX_TEXT_CHUNK + 1))
+    header = metadata.parse(_png(
+        _chunk(b'zTXt', b'bomb\x00\x00' + bomb),
+        _chunk(b'zTXt', b'corrupt\x00\x00not zlib'),
+        _chunk(b'iCCP', b'profile\x00\x00not zlib'),
+        _chunk(b'iTXt', b''),
+        _chunk(b'pHYs', b'\x00'),
+        _chunk(b'tEXt', b'kept\x00yes')))
+
+    assert (header['width'], header['height']) == (40, 30)
+    assert header['info']['kept'] == 'yes'
+    assert 'bomb' not in header['info']
+    assert 'corrupt' not in header['info']
+    assert 'icc_profile' not in header['info']
+
+
+def test_png_short_ihdr():
+    data = (metadata.PNG_SIGNATURE + _chunk(b'IHDR', b'\x00' * 5) +
+            _chunk(b'IEND', b''))
+    assert metadata.parse(data)['width'] is None
+
+
+def test_truncated():
+    data = _image('JPEG', exif=_exif())
+    with pytest.raises(metadata.HeaderTruncated) as raised:
+        metadata.parse(data[:20])
+    assert raised.value.needed > 20
+
+    header = metadata.parse(data[:raised.value.needed + 1024])
+    assert header['exif']['Make'] == 'Canon'
+
+
+def test_unknown_format():
+    with pytest.raises(metadata.UnknownFormat):
+        metadata.parse(b'GIF89a' + b'\x00' * 32)
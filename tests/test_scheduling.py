@@ -0,0 +1,70 @@
+"""
+Tests for photos3.scheduling
+"""
+import pytest
+
+from photos3.scheduling import DrainController
+from photos3.scheduling import plan_workers
+
+
+class FakeQueue(object):
+    """
+    In-memory stand-in for a boto3 SQS queue, offering just what
+    DrainController reads
+    """
+    def __init__(self, backlog=0, in_flight=0):
+        self.backlog = backlog
+        self.in_flight = in_flight
+        self.attributes = {}
+        self.loads = 0
+
+    def load(self):
+        # Attributes are only current once loaded, as with boto3
+        self.loads += 1
+        self.attributes = {
+            'ApproximateNumberOfMessages': str(self.backlog),
+            'ApproximateNumberOfMessagesNotVisible': str(self.in_flight),
+        }
+
+
+def _run(queue, **kwargs):
+    started = []
+    workers = DrainController(queue, lambda: started.append(True),
+                              **kwargs).run()
+    assert workers == len(started)
+    return workers
+
+
+@pytest.mark.parametrize('backlog, in_flight, expected', [
+    (0, 0, 0),
+    (0, 30, 0),
+    (1, 0, 1),
+    (50, 0, 1),
+    (51, 0, 2),
+    (250, 0, 5),
+    (250, 20, 3),
+    (250, 15, 3),
+    (250, 100, 0),
+    (5000, 0, 10),
+])
+def test_plan_workers(backlog, in_flight, expected):
+    assert plan_workers(backlog, in_flight=in_flight) == expected
+
+
+def test_run_starts_workers_for_backlog():
+    queue = FakeQueue(backlog=120)
+    assert _run(queue, per_worker=50) == 3
+    assert queue.loads == 1
+
+
+def test_run_counts_in_flight_workers():
+    assert _run(FakeQueue(backlog=120, in_flight=10), per_worker=50) == 2
+
+
+def test_run_respects_ceiling():
+    assert _run(FakeQueue(backlog=10000), per_worker=50, ceiling=4) == 4
+
+
+def test_run_empty_queue():
+    assert _run(FakeQueue()) == 0
+    assert _run(FakeQueue(in_flight=40)) == 0
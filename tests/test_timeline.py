@@ -0,0 +1,141 @@
+"""
+Tests for paging through photos3.model.ImageTimeline
+"""
+import datetime
+
+import pytest
+from unittest import mock
+
+from photos3.model import ImageTimeline
+
+
+class FakeResults(list):
+    """
+    Page of query results, as pynamodb's ResultIterator offers them
+    """
+    def __init__(self, entries, last_evaluated_key):
+        super(FakeResults, self).__init__(entries)
+        self.last_evaluated_key = last_evaluated_key
+
+
+class FakeTable(object):
+    """
+    In-memory stand-in for the timeline table, offering just the range
+    queries ImageTimeline.page makes
+    """
+    def __init__(self, captured):
+        self.months = {}
+        for n, time in enumerate(captured):
+            entry = ImageTimeline.entry(time, 'c{:03d}'.format(n))
+            self.months.setdefault(entry.month, []).append(entry)
+        for entries in self.months.values():
+            entries.sort(key=lambda entry: entry.sort_key)
+        self.queries = 0
+
+    def query(self, month, condition, scan_index_forward=True, limit=None,
+              last_evaluated_key=None):
+        self.queries += 1
+        low, high = (value.value['S'] for value in condition.values[1:])
+        entries = [
+            entry for entry in self.months.get(month, [])
+            if low <= entry.sort_key <= high
+        ]
+        if not scan_index_forward:
+            entries.reverse()
+
+        if last_evaluated_key is not None:
+            last = last_evaluated_key['sort_key']['S']
+            entries = [
+                entry for entry in entries
+                if (entry.sort_key > last) == scan_index_forward and
+                entry.sort_key != last
+            ]
+
+        # As DynamoDB does, stop with a key whenever the limit is reached,
+        # even if nothing is left
+        if limit is not None and len(entries) >= limit:
+            entries = entries[:limit]
+            return FakeResults(entries, {
+                'month': {'S': month},
+                'sort_key': {'S': entries[-1].sort_key},
+            })
+        return FakeResults(entries, None)
+
+
+CAPTURED = [
+    '2015-12-31T23:59:59',
+    '2016-01-01T00:00:00',
+    '2016-01-15T08:00:00',
+    '2016-01-15T08:00:00',
+    '2016-01-31T23:59:59',
+    '2016-03-05T10:11:12',
+    '2016-03-05T10:11:13',
+    '2016-04-01T00:00:00',
+    '2016-05-20T12:00:00',
+]
+
+
+@pytest.fixture
+def table():
+    table = FakeTable(CAPTURED)
+    with mock.patch.object(ImageTimeline, 'query', table.query):
+        yield table
+
+
+def _read(start, end, limit, newest_first=False):
+    entries, cursor, pages = [], None, 0
+    while True:
+        page, cursor = ImageTimeline.page(start, end,
+                                          limit=limit,
+                                          cursor=cursor,
+                                          newest_first=newest_first)
+        assert len(page) <= limit
+        entries.extend(page)
+        pages += 1
+        if cursor is None:
+            return entries, pages
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 100])
+@pytest.mark.parametrize('newest_first', [False, True])
+def test_pages_cover_range(table, limit, newest_first):
+    entries, pages = _read('2016-01', '2016-04', limit, newest_first)
+
+    expected = sorted(
+        ImageTimeline.entry(time, 'c{:03d}'.format(n)).sort_key
+        for n, time in enumerate(CAPTURED)
+        if '2016-01' <= time[:7] <= '2016-04')
+    if newest_first:
+        expected.reverse()
+    assert [entry.sort_key for entry in entries] == expected
+    assert pages >= -(-len(expected) // limit)
+
+
+def test_single_page(table):
+    entries, cursor = ImageTimeline.page('2016-01-15', '2016-03-05')
+    assert [entry.captured for entry in entries] == [
+        '2016-01-15T08:00:00',
+        '2016-01-15T08:00:00',
+        '2016-01-31T23:59:59',
+        '2016-03-05T10:11:12',
+        '2016-03-05T10:11:13',
+    ]
+    assert cursor is None
+    assert table.queries == 3
+
+
+def test_dates_and_times(table):
+    entries, _ = ImageTimeline.page(datetime.date(2016, 1, 1),
+                                    datetime.datetime(2016, 3, 5, 10, 11, 12))
+    assert entries[0].captured == '2016-01-01T00:00:00'
+    assert entries[-1].captured == '2016-03-05T10:11:12'
+
+
+def test_between(table):
+    checksums = [
+        entry.checksum
+        for entry in ImageTimeline.between('2015', '2016', page_size=2,
+                                           newest_first=True)
+    ]
+    assert checksums == ['c008', 'c007', 'c006', 'c005', 'c004',
+                         'c003', 'c002', 'c001', 'c000']
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Compares radius queries through the ImageLocation geohash layout with a
+brute force scan, over a synthetic set of geotagged photos
+
+The table is mirrored in memory: one sorted list of sort keys per partition,
+read by geohash prefix just as the range-key queries would be. Reports the
+time & number of entries read per query alongside the number of matches.
+
+Usage: bench_geo.py [<photos> [<queries>]]
+"""
+import bisect
+import collections
+import random
+import sys
+import time
+
+from photos3 import geohash
+from photos3.model import LOCATION_CELL_PRECISION
+
+
+# Query radii in metres
+RADII = [500, 5000, 50000]
+
+# Photos cluster around a few places, with the rest spread out
+CLUSTERS = 50
+CLUSTERED = 0.9
+
+
+def _photos(count):
+    centres = [(random.uniform(-60, 70), random.uniform(-180, 180))
+               for _ in range(CLUSTERS)]
+
+    for n in range(count):
+        if random.random() < CLUSTERED:
+            lat, lon = random.choice(centres)
+            yield (min(max(random.gauss(lat, 0.2), -90), 90),
+                   (random.gauss(lon, 0.2) + 180) % 360 - 180)
+        else:
+            yield random.uniform(-90, 90), random.uniform(-180, 180)
+
+
+def _index(photos):
+    partitions = collections.defaultdict(list)
+    for n, (lat, lon) in enumerate(photos):
+        position = geohash.encode(lat, lon)
+        partitions[position[:LOCATION_CELL_PRECISION]].append(
+            ("{}#{}".format(position, n), lat, lon))
+
+    for entries in partitions.values():
+        entries.sort()
+    return partitions
+
+
+def _query(partitions, lat, lon, radius):
+    south, west, north, east = geohash.radius_bounds(lat, lon, radius)
+    cells = geohash.covering_cells(south, west, north, east,
+                                   min_precision=LOCATION_CELL_PRECISION)
+
+    read = 0
+    found = []
+    for cell in cells:
+        entries = partitions.get(cell[:LOCATION_CELL_PRECISION], [])
+        first = bisect.bisect_left(entries, (cell,))
+        last = bisect.bisect_left(entries, (cell + '~',))
+        read += last - first
+        for sort_key, entry_lat, entry_lon in entries[first:last]:
+            if geohash.distance(lat, lon, entry_lat, entry_lon) <= radius:
+                found.append(sort_key)
+
+    return found, read
+
+
+def _scan(photos, lat, lon, radius):
+    return [
+        n
+        for n, (entry_lat, entry_lon) in enumerate(photos)
+        if geohash.distance(lat, lon, entry_lat, entry_lon) <= radius
+    ]
+
+
+def main(args):
+    count = int(args[0]) if args else 1000000
+    queries = int(args[1]) if len(args) > 1 else 5
+
+    random.seed(1)
+    photos = list(_photos(count))
+
+    start = time.time()
+    partitions = _index(photos)
+    print("Indexed {n} photos into {p} partitions in {t:.1f} s".format(
+        n=count,
+        p=len(partitions),
+        t=time.time() - start))
+
+    for radius in RADII:
+        index_time = scan_time = 0.0
+        read = matches = 0
+
+        for _ in range(queries):
+            # Centre queries on photos, so they find something
+            lat, lon = random.choice(photos)
+
+            start = time.time()
+            found, query_read = _query(partitions, lat, lon, radius)
+            index_time += time.time() - start
+
+            start = time.time()
+            scanned = _scan(photos, lat, lon, radius)
+            scan_time += time.time() - start
+
+            if len(found) != len(scanned):
+                print("Mismatch at {}, {}: {} vs {}".format(
+                    lat, lon, len(found), len(scanned)))
+                return 1
+
+            read += query_read
+            matches += len(found)
+
+        print("{r:>6} m: geohash {i:8.2f} ms, {c:8.0f} read | "
+              "scan {s:8.2f} ms, {n} read | {m:.0f} matches".format(
+                  r=radius,
+                  i=index_time * 1000 / queries,
+                  c=read / float(queries),
+                  s=scan_time * 1000 / queries,
+                  n=count,
+                  m=matches / float(queries)))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
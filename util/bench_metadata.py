@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Compares header parsing by photos3.metadata with the PIL based path
+
+Usage: bench_metadata.py <image> [<image> ...]
+"""
+import io
+import sys
+import timeit
+
+from PIL import Image
+
+from photos3.imgprocess import get_header_data
+from photos3.imgprocess import get_image_data
+from photos3.metadata import UnknownFormat
+
+
+ROUNDS = 20
+
+
+def _pil(data):
+    img = Image.open(io.BytesIO(data))
+    return get_image_data(img), img.size
+
+
+def main(paths):
+    corpus = []
+    for path in paths:
+        with open(path, 'rb') as imgin:
+            data = imgin.read()
+        try:
+            get_header_data(data)
+        except UnknownFormat:
+            print("Skipping unsupported {}".format(path))
+            continue
+        corpus.append(data)
+
+    if not corpus:
+        print("No supported images given")
+        return 1
+
+    for name, func in (('photos3.metadata', get_header_data), ('PIL', _pil)):
+        elapsed = timeit.timeit(
+            lambda: [func(data) for data in corpus],
+            number=ROUNDS)
+        print("{n:<18} {t:8.3f} ms/image".format(
+            n=name,
+            t=elapsed * 1000 / (ROUNDS * len(corpus))))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
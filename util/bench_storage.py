@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Compares ImageMetaData item sizes under the original JSON encoding of EXIF &
+info with their compact encoding
+
+Reports the average item size and the capacity units of writing & strongly
+consistently reading each item.
+
+Usage: bench_storage.py <image> [<image> ...]
+"""
+import base64
+import io
+import json
+import math
+import sys
+
+from PIL import Image
+from PIL.ExifTags import TAGS
+
+from photos3 import compact
+from photos3.imgprocess import _read_buffer_header
+
+
+def _legacy(img):
+    """
+    Returns info & exif as they were stored before the compact encoding
+    """
+    info = {k: v for k, v in img.info.items() if k != 'exif'}
+    for k, v in info.items():
+        if type(v) is bytes:
+            info[k] = str(base64.b64encode(v))
+
+    exif = {}
+    try:
+        exif = {
+            TAGS.get(tag, tag): str(val).strip()
+            for tag, val in img._getexif().items()
+        }
+    except AttributeError:
+        pass
+
+    return (json.dumps(info, default=str).encode('utf-8'),
+            json.dumps(exif, default=str).encode('utf-8'))
+
+
+def _item_size(checksum, info, exif):
+    """
+    Returns the size DynamoDB bills an item by
+    """
+    return sum(len(name) + len(value) for name, value in (
+        ('checksum', checksum.encode('utf-8')),
+        ('info', info),
+        ('exif', exif)))
+
+
+def main(paths):
+    if not paths:
+        print("No images given")
+        return 1
+
+    checksum = '0' * 64
+    sizes = {'legacy': [], 'compact': []}
+
+    for path in paths:
+        with open(path, 'rb') as imgin:
+            data = imgin.read()
+
+        sizes['legacy'].append(_item_size(
+            checksum, *_legacy(Image.open(io.BytesIO(data)))))
+
+        info, exif, _ = _read_buffer_header(io.BytesIO(data))
+        sizes['compact'].append(_item_size(
+            checksum, compact.encode(info), compact.encode(exif)))
+
+    for name in ('legacy', 'compact'):
+        print("{n:<8} {b:9.0f} B/item {w:6.2f} WCU {r:6.2f} RCU "
+              "(largest {m} B)".format(
+                  n=name,
+                  b=sum(sizes[name]) / float(len(paths)),
+                  w=sum(math.ceil(s / 1024.0)
+                        for s in sizes[name]) / float(len(paths)),
+                  r=sum(math.ceil(s / 4096.0)
+                        for s in sizes[name]) / float(len(paths)),
+                  m=max(sizes[name])))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Checks the cold start import cost of each Lambda handler
+
+Every handler's modules are imported in a fresh interpreter. The check fails
+when the imports take longer than the handler's budget, or when a handler
+pulls in a dependency it has no use for.
+
+Usage: import_budget.py [<budget scale>]
+"""
+import json
+import subprocess
+import sys
+
+
+# Handler: (modules imported on a cold start, modules that must not be
+# loaded, budget in milliseconds)
+HANDLERS = {
+    'process_new_image_queue': (
+        ['photos3.lambda', 'photos3.imgprocess', 'photos3.model'],
+        [],
+        1500,
+    ),
+    'process_thumbnail': (
+        ['photos3.lambda', 'photos3.imgprocess', 'photos3.model',
+         'PIL.Image'],
+        [],
+        1200,
+    ),
+    'scale_new_image_workers': (
+        ['photos3.lambda'],
+        ['PIL.Image', 'pynamodb'],
+        600,
+    ),
+}
+
+MEASURE = """
+import importlib, json, sys, time
+start = time.time()
+for module in {modules!r}:
+    importlib.import_module(module)
+print(json.dumps({{
+    'elapsed': (time.time() - start) * 1000,
+    'loaded': [m for m in {forbidden!r} if m in sys.modules],
+}}))
+"""
+
+
+def main(args):
+    scale = float(args[0]) if args else 1.0
+    failures = 0
+
+    for handler, (modules, forbidden, budget) in sorted(HANDLERS.items()):
+        output = subprocess.check_output([
+            sys.executable,
+            '-c',
+            MEASURE.format(modules=modules, forbidden=forbidden),
+        ])
+        result = json.loads(output.decode('utf-8').splitlines()[-1])
+
+        ok = result['elapsed'] <= budget * scale and not result['loaded']
+        failures += not ok
+
+        print("{s:<4} {h:<24} {e:7.1f} ms (budget {b:.0f} ms){l}".format(
+            s='ok' if ok else 'FAIL',
+            h=handler,
+            e=result['elapsed'],
+            b=budget * scale,
+            l="; loaded {}".format(", ".join(result['loaded']))
+            if result['loaded'] else ''))
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))